@@ -0,0 +1,534 @@
+import cv2
+import json
+import time
+import asyncio
+import resource
+import numpy as np
+
+from os import makedirs
+from os.path import join, getsize
+from tempfile import mkdtemp
+from argparse import ArgumentParser
+
+from omegaconf import DictConfig
+from ultralytics.engine.results import Boxes
+
+from models import Config
+from processor import FrameProcessor
+from extractor import EventExtractor
+from visualizer import EventVisualizer
+from watcher import EventWatcher
+from saver import EventSaver
+from segments import SegmentTracker
+from dedup import EventDeduplicator
+from scheduler import InferenceScheduler
+from detector import registry
+from tracks import TrackStore
+from constants import TORCH_BACKEND, ONNX_BACKEND, NEW_OBJECT, LINE_INTERSECTION, ZONE_ENTER, EVENT_NAMES, \
+    EVENTS_DTYPE
+from utils import box_iou, event_dicts
+
+
+class StubDetector:
+    # ground truth boxes of synthetic video are bright rectangles on black background:
+    async def detect(self, frames, classes, input_size):
+        detections = []
+
+        for frame in frames:
+            mask = (cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) > 128).astype(np.uint8)
+            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+            data = [[x, y, x + width, y + height, 1.0, 0] for x, y, width, height in map(cv2.boundingRect, contours)]
+            detections.append(Boxes(np.array(data, dtype=np.float32).reshape(-1, 6), frame.shape[:2]))
+
+        return detections
+
+    @property
+    def names(self):
+        return {0: 'object'}
+
+
+def processor_config(args, **overrides):
+    config = {'detector_name': args.detector_name,
+              'input_size': args.input_size,
+
+              'backend': 'torch',
+              'int8': False,
+              'threads': 0,
+
+              'ckpt_root': args.ckpt_root,
+              'tracks_root': 'tracks',
+              'tracks_flush': 0,
+
+              'track_buffer': 150,
+              'match_thresh': 0.8,
+              'new_track_thresh': 0.6,
+              'track_low_thresh': 0.1,
+              'track_high_thresh': 0.5,
+
+              'batch_size': 1,
+              'frames_skip': 0,
+              'target_labels': [0],
+
+              'motion_gate': False,
+              'motion_sensitivity': 0.002,
+
+              'adaptive_skip': False,
+              'max_frames_skip': 10,
+              'busy_tracks': 5,
+              'line_margin': 64,
+              'realtime_factor': 0.0,
+              'fps': 25,
+
+              'roi': None,
+              'roi_zones': False,
+              'roi_margin': 64,
+
+              'tile_size': 0,
+              'tile_overlap': 0.25,
+
+              'line_angle': None,
+              'line_point': None,
+
+              'zones': [],
+              'zones_cell': 128}
+
+    config.update(overrides)
+
+    return DictConfig(config)
+
+
+def load_frames(args):
+    if not args.video:
+        rng = np.random.default_rng(0)
+        return [rng.integers(0, 256, (1080, 1920, 3), dtype=np.uint8) for _ in range(args.frames)]
+
+    frames = []
+    capture = cv2.VideoCapture(args.video)
+
+    while len(frames) < args.frames:
+        success, frame = capture.read()
+
+        if not success:
+            break
+
+        frames.append(frame)
+
+    capture.release()
+
+    return frames
+
+
+async def run_processor(processor, frames):
+    start_time = time.perf_counter()
+
+    for start in range(0, len(frames), processor.batch_size):
+        indices = list(range(start, min(start + processor.batch_size, len(frames))))
+        await processor.process_frames(indices, [frames[index] for index in indices])
+
+    return len(frames) / (time.perf_counter() - start_time)
+
+
+async def benchmark_batch(args):
+    frames = load_frames(args)
+    detector = registry.get(args.detector_name, args.ckpt_root)
+
+    print('{:>12}{:>12}'.format('batch size', 'frames/s'))
+
+    for batch_size in args.batch_sizes:
+        processor = FrameProcessor(processor_config(args, batch_size=batch_size), detector, TrackStore())
+
+        # warm-up run for predictor initialization:
+        await detector.detect(frames[:batch_size], None, args.input_size)
+
+        print('{:>12}{:>12.2f}'.format(batch_size, await run_processor(processor, frames)))
+
+
+async def benchmark_segments(args):
+    config = processor_config(args, batch_size=args.batch_size)
+
+    print('{:>12}{:>12}{:>12}'.format('workers', 'seconds', 'frames/s'))
+
+    for workers in args.workers:
+        segment_tracker = SegmentTracker(workers, args.overlap, 0.5)
+
+        # worker start-up and model loading are part of wall time:
+        start_time = time.perf_counter()
+        frames_count = len([tracks async for tracks in segment_tracker.track_frames(args.video, config)])
+        wall_time = time.perf_counter() - start_time
+
+        print('{:>12}{:>12.2f}{:>12.2f}'.format(workers, wall_time, frames_count / wall_time))
+
+
+async def benchmark_streams(args):
+    frames = load_frames(args)
+    detector = registry.get(args.detector_name, args.ckpt_root)
+
+    # warm-up run for predictor initialization:
+    await detector.detect(frames[:args.batch_size], None, args.input_size)
+
+    print('{:>12}{:>16}{:>16}{:>12}'.format('streams', 'separate fps', 'shared fps', 'mean batch'))
+
+    for streams_count in args.streams:
+        results = []
+
+        # same frames are processed by every stream, each one has its own tracker:
+        for scheduler in [None, InferenceScheduler(detector, args.max_batch, args.max_latency)]:
+            processors = [FrameProcessor(processor_config(args, batch_size=args.batch_size),
+                                         scheduler.stream() if scheduler else detector, TrackStore())
+                          for _ in range(streams_count)]
+
+            start_time = time.perf_counter()
+            await asyncio.gather(*(run_processor(processor, frames) for processor in processors))
+            results.append(streams_count * len(frames) / (time.perf_counter() - start_time))
+
+        print('{:>12}{:>16.2f}{:>16.2f}{:>12.2f}'.format(streams_count, *results, scheduler.mean_batch))
+
+
+def synthetic_objects(args):
+    frame_width, frame_height = args.frame_size
+    lane_height = frame_height // (args.objects + 1)
+
+    # every object moves right in its own lane with its own speed, x and y of box left top corner on first frame:
+    return [(10, lane_height * (lane + 1) - args.box_size[1] // 2, 2 + lane % 4) for lane in range(args.objects)]
+
+
+def make_video(args, video_path):
+    frame_width, frame_height = args.frame_size
+    box_width, box_height = args.box_size
+
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter.fourcc(*'MJPG'), args.fps, (frame_width, frame_height))
+
+    for index in range(args.frames):
+        frame = np.zeros((frame_height, frame_width, 3), dtype=np.uint8)
+
+        for x_start, y_start, speed in synthetic_objects(args):
+            # objects stop at right border, so they never leave frame and get new tracks:
+            x_min = min(x_start + speed * index, frame_width - box_width - 10)
+            cv2.rectangle(frame, (x_min, y_start), (x_min + box_width, y_start + box_height), (255, 255, 255), -1)
+
+        writer.write(frame)
+
+    writer.release()
+
+
+def expected_events(args):
+    line_x = args.frame_size[0] // 2
+    events = []
+
+    for x_start, _, speed in synthetic_objects(args):
+        # objects are seen from first frame, line is crossed when box bottom center reaches it:
+        events.append((1, NEW_OBJECT))
+
+        crossing = -(-(line_x - x_start - args.box_size[0] / 2) // speed) + 1
+
+        if crossing <= args.frames:
+            events.append((int(crossing), LINE_INTERSECTION))
+
+    return sorted(events)
+
+
+def check_events(expected, found, tolerance):
+    unmatched = list(found)
+    missing = []
+
+    # tracked boxes are smoothed by Kalman filter, so crossing frame may slightly differ:
+    for frame_index, event_name in expected:
+        matches = [event for event in unmatched
+                   if event[1] == event_name and abs(event[0] - frame_index) <= tolerance]
+
+        if matches:
+            unmatched.remove(matches[0])
+        else:
+            missing.append((frame_index, event_name))
+
+    return missing, unmatched
+
+
+def make_work_dir(work_dir):
+    work_dir = work_dir or mkdtemp(prefix='watcher-benchmark-')
+
+    # given work directory may not exist yet:
+    for sub_dir in ('inputs', 'outputs', 'events', 'frames', 'tracks'):
+        makedirs(join(work_dir, sub_dir), exist_ok=True)
+
+    return work_dir
+
+
+def create_pipeline(args, work_dir, track_store):
+    frame_width, frame_height = args.frame_size
+
+    config = Config(watcher={'target_events': [NEW_OBJECT, LINE_INTERSECTION],
+                             'duplicate_interval': 1.0, 'fps': args.fps,
+                             'inputs_root': join(work_dir, 'inputs'), 'frames_root': join(work_dir, 'frames'),
+                             'metrics': True},
+                    processor={'detector_name': 'stub', 'input_size': args.input_size,
+                               'ckpt_root': '', 'tracks_root': join(work_dir, 'tracks'),
+                               'track_buffer': 150, 'match_thresh': 0.8, 'new_track_thresh': 0.6,
+                               'track_low_thresh': 0.1, 'track_high_thresh': 0.5,
+                               'batch_size': args.batch_size, 'frames_skip': 0, 'target_labels': [0],
+                               'line_angle': 90, 'line_point': [frame_width // 2, frame_height // 2]},
+                    extractor={'outputs_root': join(work_dir, 'outputs'), 'events_root': join(work_dir, 'events'),
+                               'sec_before': 1, 'sec_after': 1, 'fourcc': 'MJPG', 'fps': args.fps,
+                               'clip_mode': args.clip_mode},
+                    saver={'sql_dialect': 'sqlite', 'db_name': join(work_dir, 'events.db')})
+    config = DictConfig(config.model_dump())
+
+    processor = FrameProcessor(config.processor, StubDetector(), track_store)
+    extractor = EventExtractor(config.extractor, EventVisualizer(processor.zones), track_store)
+
+    return EventWatcher(config.watcher, processor, extractor, EventSaver(config.saver))
+
+
+async def benchmark_pipeline(args):
+    work_dir = make_work_dir(args.work_dir)
+    file_name = 'synthetic.avi'
+
+    make_video(args, join(work_dir, 'inputs', file_name))
+
+    watcher = create_pipeline(args, work_dir, TrackStore())
+    processor = watcher.processor
+
+    start_time = time.perf_counter()
+    events = await watcher.watch_events(file_name)
+    wall_time = time.perf_counter() - start_time
+
+    found = sorted((event['frame_index'], event['event_name'])
+                   for event in event_dicts(events, file_name, processor.zones.names))
+    missing, unexpected = check_events(expected_events(args), found, args.tolerance)
+
+    summary = watcher.metrics.summary()
+
+    # ru_maxrss is in kilobytes on Linux:
+    result = {'frames': args.frames,
+              'frame_size': args.frame_size,
+              'objects': args.objects,
+              'batch_size': args.batch_size,
+              'clip_mode': args.clip_mode,
+              'seconds': round(wall_time, 3),
+              'fps': round(args.frames / wall_time, 2),
+              'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+              'bytes_written': summary['counters'].get('bytes_written', 0) + getsize(join(work_dir, 'events.db')),
+              'counters': summary['counters'],
+              'stages': summary['stages'],
+              'events': len(found),
+              'correct': not missing and not unexpected,
+              'missing': missing,
+              'unexpected': unexpected}
+
+    report = json.dumps(result, indent=2)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(report)
+
+    print(report)
+
+
+def synthetic_tracks(args, frame_index):
+    frame_width, frame_height = args.frame_size
+    slots = np.arange(args.tracks)
+
+    # every slot is occupied by new track after lifetime frames, tracks move right and cross middle line:
+    ages = (frame_index + slots * args.lifetime // args.tracks) % args.lifetime
+    track_ids = (frame_index + slots * args.lifetime // args.tracks) // args.lifetime * args.tracks + slots + 1
+
+    x_min = ages * (frame_width - 40) // args.lifetime
+    y_min = (slots + 1) * frame_height // (args.tracks + 1) - 15
+
+    return np.stack([np.full(args.tracks, frame_index), x_min, y_min, x_min + 40, y_min + 30, track_ids], axis=1)
+
+
+async def benchmark_memory(args):
+    work_dir = make_work_dir(args.work_dir)
+    frames_count = int(args.hours * 3600 * args.fps)
+
+    # tracks are fed to processor directly, so day of constant traffic is simulated without video:
+    watcher = create_pipeline(args, work_dir, TrackStore(max_frames=args.tracks_window))
+    processor = watcher.processor
+
+    print('{:>10}{:>12}{:>14}{:>14}{:>14}{:>14}'.format('hours', 'frames/s', 'peak RSS, MB', 'track states',
+                                                        'fired events', 'track rows'))
+
+    start_time = time.perf_counter()
+
+    for index in range(frames_count):
+        events = processor.process_tracks(index, synthetic_tracks(args, index + 1))
+        watcher._filter_events(index + 1, events)
+
+        if not (index + 1) % (frames_count // args.samples or 1):
+            print('{:>10.2f}{:>12.0f}{:>14.1f}{:>14}{:>14}{:>14}'
+                  .format((index + 1) / args.fps / 3600, (index + 1) / (time.perf_counter() - start_time),
+                          resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, len(processor.track_states),
+                          len(watcher.deduplicator), len(processor.track_store)))
+
+    await asyncio.get_running_loop().run_in_executor(None, watcher.saver.close)
+
+
+async def benchmark_dedup(args):
+    rng = np.random.default_rng(0)
+    deduplicator = EventDeduplicator(int(args.duplicate_interval * args.fps))
+
+    # every track fires zone enter events in random zones, most of them repeat within duplicate interval:
+    batches = []
+
+    for frame_index in range(1, args.frames + 1):
+        events = np.zeros(args.events, dtype=EVENTS_DTYPE)
+        events['frame_index'] = frame_index
+        events['track_id'] = rng.integers(1, args.tracks + 1, args.events)
+        events['event_id'] = EVENT_NAMES.index(ZONE_ENTER)
+        events['zone_id'] = rng.integers(0, args.zones, args.events)
+
+        batches.append(events)
+
+    admitted = 0
+    start_time = time.perf_counter()
+
+    for frame_index, events in enumerate(batches, 1):
+        admitted += deduplicator.admit(frame_index, events).sum()
+
+    elapsed_time = time.perf_counter() - start_time
+
+    print('{:>10}{:>12}{:>14}{:>12}{:>12}'.format('tracks', 'events/s', 'us/frame', 'admitted', 'table size'))
+    print('{:>10}{:>12.0f}{:>14.1f}{:>12}{:>12}'.format(args.tracks, args.frames * args.events / elapsed_time,
+                                                        1e6 * elapsed_time / args.frames, admitted,
+                                                        len(deduplicator)))
+
+
+def match_boxes(reference_boxes, boxes, iou_thresh=0.5):
+    matched = 0
+    ious = box_iou(reference_boxes.xyxy, boxes.xyxy) * (reference_boxes.cls[:, None] == boxes.cls[None, :])
+
+    # greedy one-to-one matching of boxes with same class:
+    while ious.size and ious.max() >= iou_thresh:
+        reference_pos, pos = np.unravel_index(ious.argmax(), ious.shape)
+        ious[reference_pos, :], ious[:, pos] = 0, 0
+        matched += 1
+
+    return matched
+
+
+async def benchmark_backends(args):
+    frames = load_frames(args)
+    reference = None
+
+    print('{:>12}{:>12}{:>12}{:>12}'.format('backend', 'frames/s', 'recall', 'precision'))
+
+    for backend, int8 in [(TORCH_BACKEND, False), (ONNX_BACKEND, False), (ONNX_BACKEND, True)]:
+        detector = registry.get(args.detector_name, args.ckpt_root, backend, int8, args.threads)
+
+        # warm-up run for session initialization:
+        await detector.detect(frames[:args.batch_size], None, args.input_size)
+
+        detections = []
+        start_time = time.perf_counter()
+
+        for start in range(0, len(frames), args.batch_size):
+            detections.extend(await detector.detect(frames[start:start + args.batch_size], None, args.input_size))
+
+        frames_per_second = len(frames) / (time.perf_counter() - start_time)
+
+        # accuracy is measured against torch backend boxes:
+        if reference is None:
+            reference = detections
+
+        matched = sum(match_boxes(reference_boxes, boxes) for reference_boxes, boxes in zip(reference, detections))
+        reference_count = sum(len(boxes) for boxes in reference)
+        count = sum(len(boxes) for boxes in detections)
+
+        print('{:>12}{:>12.2f}{:>12.3f}{:>12.3f}'.format(backend + ('-int8' if int8 else ''), frames_per_second,
+                                                         matched / reference_count if reference_count else 1.0,
+                                                         matched / count if count else 1.0))
+
+
+def main():
+    parser = ArgumentParser(description="VideoEventWatcher benchmarks.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    batch_parser = subparsers.add_parser('batch', help="Processor throughput against detection batch size.")
+    batch_parser.add_argument('--ckpt-root', required=True)
+    batch_parser.add_argument('--detector-name', default='yolov8-n')
+    batch_parser.add_argument('--input-size', type=int, default=480)
+    batch_parser.add_argument('--video', default=None)
+    batch_parser.add_argument('--frames', type=int, default=256)
+    batch_parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    batch_parser.set_defaults(handler=benchmark_batch)
+
+    segments_parser = subparsers.add_parser('segments', help="Segment-parallel tracking wall time against workers.")
+    segments_parser.add_argument('--ckpt-root', required=True)
+    segments_parser.add_argument('--detector-name', default='yolov8-n')
+    segments_parser.add_argument('--input-size', type=int, default=480)
+    segments_parser.add_argument('--video', required=True)
+    segments_parser.add_argument('--batch-size', type=int, default=4)
+    segments_parser.add_argument('--overlap', type=int, default=25)
+    segments_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    segments_parser.set_defaults(handler=benchmark_segments)
+
+    streams_parser = subparsers.add_parser('streams', help="Aggregate throughput of concurrent streams against "
+                                                           "shared batching.")
+    streams_parser.add_argument('--ckpt-root', required=True)
+    streams_parser.add_argument('--detector-name', default='yolov8-n')
+    streams_parser.add_argument('--input-size', type=int, default=480)
+    streams_parser.add_argument('--video', default=None)
+    streams_parser.add_argument('--frames', type=int, default=64)
+    streams_parser.add_argument('--batch-size', type=int, default=1)
+    streams_parser.add_argument('--max-batch', type=int, default=16)
+    streams_parser.add_argument('--max-latency', type=float, default=0.02)
+    streams_parser.add_argument('--streams', type=int, nargs='+', default=[1, 4, 16])
+    streams_parser.set_defaults(handler=benchmark_streams)
+
+    pipeline_parser = subparsers.add_parser('pipeline', help="End-to-end run on synthetic video with stub detector "
+                                                             "and SQLite, JSON report with event correctness check.")
+    pipeline_parser.add_argument('--work-dir', default=None)
+    pipeline_parser.add_argument('--output', default=None)
+    pipeline_parser.add_argument('--frames', type=int, default=300)
+    pipeline_parser.add_argument('--frame-size', type=int, nargs=2, default=[640, 360])
+    pipeline_parser.add_argument('--box-size', type=int, nargs=2, default=[40, 30])
+    pipeline_parser.add_argument('--objects', type=int, default=4)
+    pipeline_parser.add_argument('--fps', type=int, default=25)
+    pipeline_parser.add_argument('--input-size', type=int, default=480)
+    pipeline_parser.add_argument('--batch-size', type=int, default=4)
+    pipeline_parser.add_argument('--clip-mode', default='annotated')
+    pipeline_parser.add_argument('--tolerance', type=int, default=2)
+    pipeline_parser.set_defaults(handler=benchmark_pipeline)
+
+    memory_parser = subparsers.add_parser('memory', help="Memory of long job with constant traffic on synthetic "
+                                                         "tracks.")
+    memory_parser.add_argument('--work-dir', default=None)
+    memory_parser.add_argument('--hours', type=float, default=24)
+    memory_parser.add_argument('--samples', type=int, default=12)
+    memory_parser.add_argument('--tracks', type=int, default=20)
+    memory_parser.add_argument('--lifetime', type=int, default=250)
+    memory_parser.add_argument('--tracks-window', type=int, default=3000)
+    memory_parser.add_argument('--frame-size', type=int, nargs=2, default=[1920, 1080])
+    memory_parser.add_argument('--fps', type=int, default=25)
+    memory_parser.add_argument('--input-size', type=int, default=480)
+    memory_parser.add_argument('--batch-size', type=int, default=1)
+    memory_parser.add_argument('--clip-mode', default='annotated')
+    memory_parser.set_defaults(handler=benchmark_memory)
+
+    dedup_parser = subparsers.add_parser('dedup', help="Event deduplication throughput with many concurrent tracks.")
+    dedup_parser.add_argument('--tracks', type=int, default=5000)
+    dedup_parser.add_argument('--zones', type=int, default=8)
+    dedup_parser.add_argument('--events', type=int, default=500)
+    dedup_parser.add_argument('--frames', type=int, default=10000)
+    dedup_parser.add_argument('--duplicate-interval', type=float, default=2.0)
+    dedup_parser.add_argument('--fps', type=int, default=25)
+    dedup_parser.set_defaults(handler=benchmark_dedup)
+
+    backends_parser = subparsers.add_parser('backends', help="Detector throughput and accuracy against backend.")
+    backends_parser.add_argument('--ckpt-root', required=True)
+    backends_parser.add_argument('--detector-name', default='yolov8-n')
+    backends_parser.add_argument('--input-size', type=int, default=480)
+    backends_parser.add_argument('--video', default=None)
+    backends_parser.add_argument('--frames', type=int, default=128)
+    backends_parser.add_argument('--batch-size', type=int, default=4)
+    backends_parser.add_argument('--threads', type=int, default=0)
+    backends_parser.set_defaults(handler=benchmark_backends)
+
+    args = parser.parse_args()
+    asyncio.run(args.handler(args))
+
+
+if __name__ == '__main__':
+    main()
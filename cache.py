@@ -0,0 +1,136 @@
+import json
+import hashlib
+import numpy as np
+
+from os import makedirs, listdir, remove, replace, stat, utime
+from os.path import join, exists, getsize
+from threading import Lock
+from tempfile import TemporaryFile
+
+from constants import CACHE_CHUNK_SIZE
+from utils import create_logger
+
+
+class DetectionCache:
+    logger = create_logger(__name__)
+
+    # content hashes of already seen files, keyed by path, size and modification time:
+    _file_hashes = {}
+    _lock = Lock()
+
+    def __init__(self, cache_root, max_size):
+        self.cache_root = cache_root
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+
+        makedirs(self.cache_root, exist_ok=True)
+
+    @classmethod
+    def file_hash(cls, file_path):
+        file_stat = stat(file_path)
+        file_key = (file_path, file_stat.st_size, file_stat.st_mtime_ns)
+
+        if file_key not in cls._file_hashes:
+            file_hash = hashlib.sha1()
+
+            with open(file_path, 'rb') as input_file:
+                for chunk in iter(lambda: input_file.read(CACHE_CHUNK_SIZE), b''):
+                    file_hash.update(chunk)
+
+            cls._file_hashes[file_key] = file_hash.hexdigest()
+
+        return cls._file_hashes[file_key]
+
+    @staticmethod
+    def get_key(file_hash, **params):
+        return hashlib.sha1((file_hash + json.dumps(params, sort_keys=True)).encode()).hexdigest()
+
+    def load(self, key):
+        cache_path = self._cache_path(key)
+
+        if not exists(cache_path):
+            self.misses += 1
+            return None
+
+        with np.load(cache_path) as cache_file:
+            arrays = dict(cache_file)
+
+        # modification time marks recently used entries:
+        utime(cache_path)
+        self.hits += 1
+
+        return arrays
+
+    def save(self, key, **arrays):
+        cache_path = self._cache_path(key)
+        temp_path = cache_path + '.tmp'
+
+        # entry appears only when written completely:
+        with open(temp_path, 'wb') as temp_file:
+            np.savez(temp_file, **arrays)
+
+        replace(temp_path, cache_path)
+
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            entries = [join(self.cache_root, name) for name in listdir(self.cache_root) if name.endswith('.npz')]
+            entries.sort(key=lambda path: stat(path).st_mtime)
+
+            total_size = sum(getsize(path) for path in entries)
+
+            # least recently used entries are removed first:
+            for path in entries:
+                if total_size <= self.max_size:
+                    break
+
+                total_size -= getsize(path)
+                remove(path)
+
+                self.logger.info("Evict '{}' entry from detection cache.".format(path))
+
+    def _cache_path(self, key):
+        return join(self.cache_root, key + '.npz')
+
+
+class DetectionSpill:
+    def __init__(self, spill_root):
+        # detections of long jobs are kept on disk, anonymous files disappear with failed jobs too:
+        self._frames_file = TemporaryFile(dir=spill_root)
+        self._rows_file = TemporaryFile(dir=spill_root)
+
+        self._frames_count = 0
+
+    def append(self, frame_index, detections):
+        np.array([frame_index, len(detections)], dtype=np.int64).tofile(self._frames_file)
+        np.asarray(detections, dtype=np.float32).reshape(-1, 6).tofile(self._rows_file)
+
+        self._frames_count += 1
+
+    def arrays(self):
+        self._frames_file.flush()
+        self._rows_file.flush()
+
+        frames = self._map(self._frames_file, np.int64).reshape(-1, 2)
+        rows = self._map(self._rows_file, np.float32).reshape(-1, 6)
+
+        # detections of all frames are stored in one array, frame i owns [offsets[i], offsets[i + 1]) rows:
+        return frames[:, 0], np.concatenate([[0], np.cumsum(frames[:, 1])]), rows
+
+    def close(self):
+        self._frames_file.close()
+        self._rows_file.close()
+
+    @staticmethod
+    def _map(spill_file, dtype):
+        # empty file can not be memory-mapped:
+        if not spill_file.tell():
+            return np.empty(0, dtype=dtype)
+
+        return np.memmap(spill_file, dtype=dtype, mode='r')
+
+    def __len__(self):
+        return self._frames_count
@@ -0,0 +1,71 @@
+import json
+import pickle
+import asyncio
+import hashlib
+
+from os import makedirs, remove, replace, stat
+from os.path import join, exists, splitext
+
+from utils import create_logger
+
+
+class JobCheckpointer:
+    logger = create_logger(__name__)
+
+    def __init__(self, checkpoint_root, interval):
+        self.checkpoint_root = checkpoint_root
+        self.interval = interval
+
+        makedirs(self.checkpoint_root, exist_ok=True)
+
+    @staticmethod
+    def get_key(input_path, **params):
+        # checkpoint is stale when video file or any processing parameter is changed:
+        file_stat = stat(input_path)
+        params['file'] = (input_path, file_stat.st_size, file_stat.st_mtime_ns)
+
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    async def save(self, file_name, key, state):
+        # state is serialized before next frames change it, only writing is left to executor:
+        data = pickle.dumps(dict(state, key=key), protocol=pickle.HIGHEST_PROTOCOL)
+
+        await asyncio.get_running_loop().run_in_executor(None, self._write, self._checkpoint_path(file_name), data)
+
+        self.logger.info("Save checkpoint of '{}' video at frame {}.".format(file_name, state['frame_index']))
+
+    def load(self, file_name, key):
+        checkpoint_path = self._checkpoint_path(file_name)
+
+        if not exists(checkpoint_path):
+            return None
+
+        with open(checkpoint_path, 'rb') as checkpoint_file:
+            state = pickle.load(checkpoint_file)
+
+        if state['key'] != key:
+            self.logger.info("Ignore stale checkpoint of '{}' video.".format(file_name))
+            return None
+
+        self.logger.info("Resume '{}' video from checkpoint at frame {}.".format(file_name, state['frame_index']))
+
+        return state
+
+    def remove(self, file_name):
+        checkpoint_path = self._checkpoint_path(file_name)
+
+        if exists(checkpoint_path):
+            remove(checkpoint_path)
+
+    @staticmethod
+    def _write(checkpoint_path, data):
+        temp_path = checkpoint_path + '.tmp'
+
+        # previous checkpoint is replaced only by completely written one:
+        with open(temp_path, 'wb') as temp_file:
+            temp_file.write(data)
+
+        replace(temp_path, checkpoint_path)
+
+    def _checkpoint_path(self, file_name):
+        return join(self.checkpoint_root, splitext(file_name)[0] + '.ckpt')
@@ -1,9 +1,85 @@
+import numpy as np
+
+
 NEW_OBJECT = 'new object'
 LINE_INTERSECTION = 'line intersection'
+ZONE_ENTER = 'zone enter'
+ZONE_EXIT = 'zone exit'
+
+# event names are stored by their indices in this tuple:
+EVENT_NAMES = (NEW_OBJECT, LINE_INTERSECTION, ZONE_ENTER, ZONE_EXIT)
+EVENTS_DTYPE = np.dtype([('timestamp', 'datetime64[s]'), ('frame_index', np.int32),
+                         ('track_id', np.int32), ('event_id', np.int8), ('zone_id', np.int16)])
+
+LINE_ZONE = 'line'
+POLYGON_ZONE = 'polygon'
+
+MAX_FRAME_SIZE = 8192
 
-TRACKS_DF_COLUMNS = ['frame_index', 'x_min', 'y_min', 'x_max', 'y_max', 'track_id']
+ANNOTATED_CLIPS = 'annotated'
+COPIED_CLIPS = 'copy'
+
+# annotated clips are encoded once to browser-playable H.264:
+CLIP_EXTENSION = '.mp4'
+
+# frames waiting for every clip encoder:
+CLIP_QUEUE_SIZE = 32
+
+TRACKS_COLUMNS = ['frame_index', 'x_min', 'y_min', 'x_max', 'y_max', 'track_id']
 
 DATETIME_FMT = '%Y.%m.%d %H:%M:%S'
 
-INTERSECT_THRESH = 1.35
-DELAY_TIME = 0.05
+MAX_DETECTORS = 2
+
+TORCH_BACKEND = 'torch'
+ONNX_BACKEND = 'onnx'
+
+# same thresholds as ultralytics predictor defaults:
+DETECT_CONF = 0.25
+DETECT_IOU = 0.7
+
+# motion gate compares blurred grayscale copies of this width:
+MOTION_WIDTH = 160
+MOTION_PIXEL_THRESH = 25
+
+# boxes of neighbouring tiles are merged when this share of smaller one is covered:
+TILES_MERGE_THRESH = 0.5
+
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+
+CACHE_CHUNK_SIZE = 1 << 20
+
+# processor options detections depend on, zones define region of interest when roi_zones is set:
+DETECTIONS_PARAMS = ('detector_name', 'ckpt_root', 'backend', 'int8', 'input_size', 'target_labels',
+                     'roi', 'roi_zones', 'roi_margin', 'tile_size', 'tile_overlap')
+ZONES_PARAMS = ('line_angle', 'line_point', 'zones')
+
+# processor options tracks depend on, zones matter for adaptive frames skip near lines:
+TRACKS_PARAMS = ('track_buffer', 'match_thresh', 'new_track_thresh', 'track_low_thresh', 'track_high_thresh',
+                 'batch_size', 'frames_skip', 'motion_gate', 'motion_sensitivity', 'adaptive_skip',
+                 'max_frames_skip', 'busy_tracks', 'line_margin', 'realtime_factor', 'fps')
+
+MAX_JOBS = 2
+
+# frames of concurrent jobs are batched together, batch waits for other jobs no longer than latency in seconds:
+SHARED_BATCH = 16
+SHARED_LATENCY = 0.02
+MAX_FINISHED_JOBS = 100
+
+# upper bounds of stage latency histogram buckets in seconds:
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_PREFIX = 'video_event_watcher'
+
+COCO_NAMES = ('person', 'bicycle', 'car', 'motorcycle', 'airplane', 'bus', 'train', 'truck', 'boat', 'traffic light',
+              'fire hydrant', 'stop sign', 'parking meter', 'bench', 'bird', 'cat', 'dog', 'horse', 'sheep', 'cow',
+              'elephant', 'bear', 'zebra', 'giraffe', 'backpack', 'umbrella', 'handbag', 'tie', 'suitcase', 'frisbee',
+              'skis', 'snowboard', 'sports ball', 'kite', 'baseball bat', 'baseball glove', 'skateboard', 'surfboard',
+              'tennis racket', 'bottle', 'wine glass', 'cup', 'fork', 'knife', 'spoon', 'bowl', 'banana', 'apple',
+              'sandwich', 'orange', 'broccoli', 'carrot', 'hot dog', 'pizza', 'donut', 'cake', 'chair', 'couch',
+              'potted plant', 'bed', 'dining table', 'toilet', 'tv', 'laptop', 'mouse', 'remote', 'keyboard',
+              'cell phone', 'microwave', 'oven', 'toaster', 'sink', 'refrigerator', 'book', 'clock', 'vase', 'scissors',
+              'teddy bear', 'hair drier', 'toothbrush')
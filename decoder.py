@@ -0,0 +1,171 @@
+import cv2
+import asyncio
+import numpy as np
+
+from threading import Event
+from subprocess import Popen, PIPE, DEVNULL
+from collections import deque
+
+from utils import create_logger
+
+
+class FrameDecoder:
+    logger = create_logger(__name__)
+
+    def __init__(self, buffer_size):
+        self.buffer_size = buffer_size
+
+    async def decode_frames(self, input_path, detect_size=None, full_resolution=True, start_index=0):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self.buffer_size)
+        stop_event = Event()
+
+        # frames come in pairs of output frame and detection frame:
+        if detect_size is None:
+            read_frames = self._read_frames
+        elif full_resolution:
+            read_frames = self._read_resized_frames
+        else:
+            read_frames = self._read_scaled_frames
+
+        # decoding thread fills queue while consumer runs inference:
+        reader = loop.run_in_executor(None, read_frames, input_path, detect_size, start_index, queue, loop, stop_event)
+
+        try:
+            while True:
+                frames = await queue.get()
+
+                if frames is None:
+                    break
+
+                yield frames
+        finally:
+            stop_event.set()
+
+            # unblock reader if it waits for free queue slot:
+            while not queue.empty():
+                queue.get_nowait()
+
+            await reader
+
+    @staticmethod
+    def probe_size(input_path):
+        capture = cv2.VideoCapture(input_path)
+        frame_size = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        capture.release()
+
+        return frame_size
+
+    @staticmethod
+    def detect_size(frame_size, input_size):
+        frame_width, frame_height = frame_size
+        scale = min(input_size / max(frame_width, frame_height), 1.0)
+
+        # even sizes suit most pixel formats, frames are never upscaled:
+        return max(int(frame_width * scale) // 2 * 2, 2), max(int(frame_height * scale) // 2 * 2, 2)
+
+    def _read_frames(self, input_path, detect_size, start_index, queue, loop, stop_event):
+        self._read_capture(input_path, start_index, queue, loop, stop_event, lambda frame: (frame, frame))
+
+    def _read_resized_frames(self, input_path, detect_size, start_index, queue, loop, stop_event):
+        # full resolution frames are kept for output, detection gets area-resized copy:
+        self._read_capture(input_path, start_index, queue, loop, stop_event,
+                           lambda frame: (frame, cv2.resize(frame, detect_size, interpolation=cv2.INTER_AREA)))
+
+    def _read_capture(self, input_path, start_index, queue, loop, stop_event, make_frames):
+        capture = cv2.VideoCapture(input_path)
+
+        if not capture.isOpened():
+            asyncio.run_coroutine_threadsafe(queue.put(None), loop).result()
+            raise IOError("Failed to open '{}' video.".format(input_path))
+
+        self.logger.info("Decode '{}' video in streaming mode.".format(input_path))
+
+        index = 0
+
+        try:
+            # frames are skipped without conversion, seeking by frame number is not exact for every container:
+            while index < start_index and not stop_event.is_set() and capture.grab():
+                index += 1
+
+            while not stop_event.is_set():
+                success, frame = capture.read()
+
+                if not success:
+                    break
+
+                index += 1
+                asyncio.run_coroutine_threadsafe(queue.put(make_frames(frame)), loop).result()
+        finally:
+            capture.release()
+
+            if not stop_event.is_set():
+                asyncio.run_coroutine_threadsafe(queue.put(None), loop).result()
+
+        self.logger.info("Decoded {} frames from '{}' video.".format(index, input_path))
+
+    def _read_scaled_frames(self, input_path, detect_size, start_index, queue, loop, stop_event):
+        frame_width, frame_height = detect_size
+        frame_bytes = frame_width * frame_height * 3
+
+        # ffmpeg scales frames right after decoding, full resolution frames never reach python:
+        process = Popen(['ffmpeg', '-loglevel', 'error', '-i', input_path,
+                         '-vf', 'scale={}:{}:flags=area'.format(frame_width, frame_height),
+                         '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1'], stdin=DEVNULL, stdout=PIPE)
+
+        self.logger.info("Decode '{}' video in streaming mode at {}x{}.".format(input_path, frame_width, frame_height))
+
+        index = 0
+
+        try:
+            while not stop_event.is_set():
+                buffer = process.stdout.read(frame_bytes)
+
+                if len(buffer) < frame_bytes:
+                    break
+
+                index += 1
+
+                if index <= start_index:
+                    continue
+
+                frame = np.frombuffer(buffer, dtype=np.uint8).reshape(frame_height, frame_width, 3)
+                asyncio.run_coroutine_threadsafe(queue.put((frame, frame)), loop).result()
+        finally:
+            process.kill()
+            process.wait()
+
+            if not stop_event.is_set():
+                asyncio.run_coroutine_threadsafe(queue.put(None), loop).result()
+
+        self.logger.info("Decoded {} frames from '{}' video.".format(index, input_path))
+
+
+class FrameBuffer:
+    def __init__(self, capacity):
+        # oldest frames are dropped once capacity is reached:
+        self._frames = deque(maxlen=capacity)
+
+    def append(self, index, frame):
+        self._frames.append((index, frame))
+
+    def frames(self, start_index, end_index):
+        for index, frame in self._frames:
+            if start_index <= index < end_index:
+                yield index, frame
+
+    @property
+    def last(self):
+        return self._frames[-1]
+
+    @property
+    def last_index(self):
+        return self._frames[-1][0]
+
+    @property
+    def frame_size(self):
+        frame_height, frame_width, _ = self._frames[-1][1].shape
+        return frame_width, frame_height
+
+    def __len__(self):
+        return len(self._frames)
@@ -0,0 +1,53 @@
+import numpy as np
+
+from itertools import repeat
+
+from constants import EVENT_NAMES
+
+
+class EventDeduplicator:
+    def __init__(self, duplicate_frames):
+        self.duplicate_frames = duplicate_frames
+
+        # last frame every event key fired at:
+        self._last_fired = {}
+
+        # keys fired at frame i wait in bucket i % len(_wheel) until duplicate interval is over:
+        self._wheel = [[] for _ in range(duplicate_frames + 1)]
+        self._expired_frame = 0
+
+    def admit(self, frame_index, events):
+        self._expire(frame_index - self.duplicate_frames - 1)
+
+        keys = self.event_keys(events)
+        return np.fromiter(map(self._fire, keys, repeat(frame_index)), dtype=bool, count=len(keys))
+
+    @staticmethod
+    def event_keys(events):
+        # track ID, event ID and zone ID are packed into one integer key:
+        return ((events['track_id'].astype(np.int64) * len(EVENT_NAMES) + events['event_id']) << 16) + \
+            (events['zone_id'].astype(np.int64) + 1)
+
+    def _fire(self, key, frame_index):
+        if key in self._last_fired:
+            return False
+
+        self._last_fired[key] = frame_index
+        self._wheel[frame_index % len(self._wheel)].append(key)
+
+        return True
+
+    def _expire(self, last_frame):
+        # every bucket is cleared once per turn of wheel, so each key is expired in O(1):
+        for frame_index in range(max(self._expired_frame + 1, last_frame - len(self._wheel) + 1), last_frame + 1):
+            bucket = self._wheel[frame_index % len(self._wheel)]
+
+            for key in bucket:
+                del self._last_fired[key]
+
+            bucket.clear()
+
+        self._expired_frame = max(self._expired_frame, last_frame)
+
+    def __len__(self):
+        return len(self._last_fired)
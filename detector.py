@@ -0,0 +1,218 @@
+import torch
+import asyncio
+import numpy as np
+
+from math import ceil
+from ast import literal_eval
+from threading import Lock
+from os.path import join, exists, normpath, splitext
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from ultralytics import YOLO
+from ultralytics.nn.tasks import torch_safe_load
+from ultralytics.utils.ops import scale_boxes
+from ultralytics.data.augment import LetterBox
+from ultralytics.engine.results import Boxes
+
+try:
+    from ultralytics.utils.nms import non_max_suppression
+except ImportError:
+    from ultralytics.utils.ops import non_max_suppression
+
+from scheduler import InferenceScheduler
+from constants import COCO_NAMES, MAX_DETECTORS, TORCH_BACKEND, ONNX_BACKEND, DETECT_CONF, DETECT_IOU
+from utils import create_logger
+
+
+class Detector:
+    def __init__(self, checkpoint_path, device):
+        self.device = device
+
+        self.model = YOLO(model=checkpoint_path, verbose=False)
+        self.model.to(self.device)
+
+        # single worker keeps model calls serialized, torch releases GIL inside:
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='detector')
+
+    async def detect(self, frames, classes, input_size):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._detect, frames, classes, input_size)
+
+    def _detect(self, frames, classes, input_size):
+        # all frames go through model in one forward pass:
+        with torch.no_grad():
+            results = self.model(source=frames, classes=classes, imgsz=input_size, batch=len(frames))
+
+        return [result.boxes.cpu().numpy() for result in results]
+
+    def close(self):
+        # idle worker thread exits, job still using evicted detector starts new one on next call:
+        self._executor.shutdown(wait=False)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='detector')
+
+    @property
+    def names(self):
+        return dict(self.model.names)
+
+
+class OnnxDetector:
+    def __init__(self, model_path, threads):
+        # onnxruntime is needed only for this backend:
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+
+        if threads:
+            options.intra_op_num_threads = threads
+
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+        # exported model keeps class names and stride in its metadata:
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self._names = literal_eval(metadata['names']) if 'names' in metadata else dict(enumerate(COCO_NAMES))
+        self.stride = int(metadata.get('stride', 32))
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='detector')
+
+    async def detect(self, frames, classes, input_size):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._detect, frames, classes, input_size)
+
+    def _detect(self, frames, classes, input_size):
+        image_size = ceil(input_size / self.stride) * self.stride
+        letterbox = LetterBox(new_shape=(image_size, image_size), auto=False, stride=self.stride)
+
+        # same preprocessing as ultralytics predictor: letterbox, BGR to RGB, HWC to CHW, 0-1 range:
+        images = np.stack([letterbox(image=frame) for frame in frames])[..., ::-1].transpose(0, 3, 1, 2)
+        images = np.ascontiguousarray(images, dtype=np.float32) / 255
+
+        predictions = self.session.run(None, {self.input_name: images})[0]
+        results = non_max_suppression(torch.from_numpy(predictions), conf_thres=DETECT_CONF, iou_thres=DETECT_IOU,
+                                      classes=classes)
+
+        # boxes are returned in frame coordinates, just like result.boxes of torch backend:
+        return [Boxes(torch.cat([scale_boxes(images.shape[2:], result[:, :4], frame.shape), result[:, 4:6]], dim=1)
+                      .numpy(), frame.shape[:2]) for frame, result in zip(frames, results)]
+
+    def close(self):
+        # idle worker thread exits, job still using evicted detector starts new one on next call:
+        self._executor.shutdown(wait=False)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='detector')
+
+    @property
+    def names(self):
+        return dict(self._names)
+
+    @staticmethod
+    def export(checkpoint_path, int8):
+        base_path = splitext(checkpoint_path)[0]
+        model_path = base_path + '.onnx'
+
+        # exported model is cached next to checkpoint:
+        if not exists(model_path):
+            YOLO(model=checkpoint_path, verbose=False).export(format='onnx', dynamic=True)
+
+        if not int8:
+            return model_path
+
+        quantized_path = base_path + '-int8.onnx'
+
+        if not exists(quantized_path):
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QUInt8)
+
+        return quantized_path
+
+
+class DetectorRegistry:
+    logger = create_logger(__name__)
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+        self._detectors = OrderedDict()
+        self._schedulers = {}
+        self._names = {}
+        self._lock = Lock()
+
+    def get(self, detector_name, ckpt_root, backend=TORCH_BACKEND, int8=False, threads=0):
+        key = (detector_name, ckpt_root, self.device, backend, int8, threads)
+
+        with self._lock:
+            if key in self._detectors:
+                self._detectors.move_to_end(key)
+                return self._detectors[key]
+
+            checkpoint_path = str(join(ckpt_root, detector_name + '.pt'))
+
+            if backend == ONNX_BACKEND:
+                model_path = OnnxDetector.export(checkpoint_path, int8)
+                detector = OnnxDetector(model_path, threads)
+            elif backend == TORCH_BACKEND:
+                model_path = checkpoint_path
+                detector = Detector(checkpoint_path, self.device)
+            else:
+                raise ValueError("Unknown detector backend '{}'.".format(backend))
+
+            self.logger.info("Load '{}' detector with {} backend on {}.".format(model_path, backend, self.device))
+
+            self._detectors[key] = detector
+            self._names[self._names_key(detector_name, ckpt_root)] = detector.names
+
+            # running jobs keep their references to evicted detectors:
+            if len(self._detectors) > self.max_size:
+                evicted_key, evicted_detector = self._detectors.popitem(last=False)
+                self._schedulers.pop(evicted_key, None)
+                evicted_detector.close()
+                self.logger.info("Evict '{}' detector from cache.".format(evicted_key[0]))
+
+            return detector
+
+    def get_shared(self, detector_name, ckpt_root, backend=TORCH_BACKEND, int8=False, threads=0,
+                   max_batch=1, max_latency=0.0):
+        detector = self.get(detector_name, ckpt_root, backend, int8, threads)
+        key = (detector_name, ckpt_root, self.device, backend, int8, threads)
+
+        # every job gets its own stream of one scheduler, so frames of concurrent jobs share detector batches:
+        with self._lock:
+            if key not in self._schedulers or self._schedulers[key].detector is not detector:
+                self._schedulers[key] = InferenceScheduler(detector, max_batch, max_latency)
+
+            return self._schedulers[key].stream()
+
+    def warm_up(self, detector_name, ckpt_root, input_size=640):
+        detector = self.get(detector_name, ckpt_root)
+        detector._detect([np.zeros((input_size, input_size, 3), dtype=np.uint8)], None, input_size)
+
+    def get_names(self, detector_name, ckpt_root):
+        names_key = self._names_key(detector_name, ckpt_root)
+
+        if names_key in self._names:
+            return self._names[names_key]
+
+        checkpoint_path = str(join(ckpt_root, detector_name + '.pt'))
+
+        # stock YOLOv8 checkpoints are downloaded on first load and trained on COCO:
+        if not exists(checkpoint_path):
+            self.logger.warning("Checkpoint '{}' not found, COCO class names are used.".format(checkpoint_path))
+            return dict(enumerate(COCO_NAMES))
+
+        # names of custom models are read from checkpoint on CPU, model is not moved to device:
+        checkpoint, _ = torch_safe_load(checkpoint_path)
+        names = (checkpoint.get('ema') or checkpoint['model']).names
+
+        with self._lock:
+            self._names[names_key] = dict(names) if isinstance(names, dict) else dict(enumerate(names))
+
+        return self._names[names_key]
+
+    @staticmethod
+    def _names_key(detector_name, ckpt_root):
+        # same checkpoint file reached by different paths shares names, file names are case-sensitive:
+        return normpath(join(ckpt_root, detector_name))
+
+
+registry = DetectorRegistry(MAX_DETECTORS)
@@ -1,129 +1,275 @@
 import cv2
-import pandas as pd
+import asyncio
+import numpy as np
 
+from os import mkdir, cpu_count
+from queue import Queue
+from threading import Thread
+from subprocess import Popen, PIPE
 from collections import deque
-from os import mkdir, listdir
-from os.path import join, exists, splitext
+from os.path import join, exists, splitext, getsize
 
-from constants import TRACKS_DF_COLUMNS
-from utils import sorted_listdir, create_logger
+from ffmpeg.asyncio import FFmpeg
+
+from decoder import FrameBuffer
+from metrics import JobMetrics
+from constants import EVENT_NAMES, EVENTS_DTYPE, COPIED_CLIPS, CLIP_EXTENSION, CLIP_QUEUE_SIZE
+from utils import create_logger
+
+
+class ClipWriter:
+    def __init__(self, output_path, fps, frame_size, codec):
+        frame_width, frame_height = frame_size
+
+        # raw frames are piped to ffmpeg, so clip is encoded only once, single thread per encoder,
+        # as busy frames open dozens of clips:
+        self._process = Popen(['ffmpeg', '-y', '-loglevel', 'error', '-filter_threads', '1',
+                               '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-video_size',
+                               '{}x{}'.format(frame_width, frame_height), '-framerate', str(fps), '-i', '-',
+                               '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-c:v', codec, '-threads', '1',
+                               '-pix_fmt', 'yuv420p', '-movflags', '+faststart', output_path], stdin=PIPE)
+
+        # frames are piped from own thread, so slow encoder does not block event loop:
+        self._frames = Queue(maxsize=CLIP_QUEUE_SIZE)
+        self._thread = Thread(target=self._pipe_frames, name='clip', daemon=True)
+        self._thread.start()
+
+    def write(self, frame):
+        self._frames.put(frame)
+
+    def release(self):
+        self._frames.put(None)
+        self._thread.join()
+        self._process.wait()
+
+    def _pipe_frames(self):
+        failed = False
+
+        try:
+            while True:
+                frame = self._frames.get()
+
+                if frame is None:
+                    break
+
+                # frames are still taken from queue after encoder failure, so writer never blocks:
+                if failed:
+                    continue
+
+                try:
+                    self._process.stdin.write(frame.tobytes())
+                except OSError:
+                    failed = True
+        finally:
+            try:
+                self._process.stdin.close()
+            except OSError:
+                pass
+
+
+class EventClip:
+    __slots__ = ('writer', 'output_path', 'event', 'track_id', 'event_name', 'end_index')
+
+    def __init__(self, writer, output_path, event, end_index):
+        self.writer = writer
+        self.output_path = output_path
+        self.event = event
+        self.track_id = event['track_id']
+        self.event_name = EVENT_NAMES[event['event_id']]
+        self.end_index = end_index
 
 
 class EventExtractor:
     logger = create_logger(__name__)
 
-    def __init__(self, config, visualizer):
+    def __init__(self, config, visualizer, track_store):
         self.outputs_root = config.outputs_root
-        self.frames_root = config.frames_root
-        self.tracks_root = config.tracks_root
         self.events_root = config.events_root
 
         self.fourcc = cv2.VideoWriter.fourcc(*config.fourcc)
         self.fps = config.fps
 
+        self.clip_mode = config.clip_mode
+        self.clip_codec = config.clip_codec
+
         self.frames_before = config.sec_before * self.fps
         self.frames_after = config.sec_after * self.fps
 
         self._events_queue = deque()
 
-        self.visualizer = visualizer
+        # clip start is never older than frames_before:
+        self._frame_buffer = FrameBuffer(self.frames_before + 1)
 
-    def extract_video(self, file_name):
-        base_name = splitext(file_name)[0]
+        self._clips = []
+        self._cuts = []
 
-        output_path = str(join(self.outputs_root, file_name))
-        frames_dir = str(join(self.frames_root, base_name))
-        tracks_dir = str(join(self.tracks_root, base_name))
+        self._video_writer = None
+        self._last_index = 0
 
-        # crutch for getting frame size:
-        temp_frame = cv2.imread(join(frames_dir, listdir(frames_dir)[0]))
-        frame_height, frame_width, _ = temp_frame.shape
-        frame_size = (frame_width, frame_height)
+        # resumed job writes whole video from this frame on:
+        self.video_start = 1
 
-        writer = cv2.VideoWriter(filename=output_path, fourcc=self.fourcc, fps=self.fps, frameSize=frame_size)
+        self.visualizer = visualizer
+        self.track_store = track_store
+
+        self.metrics = JobMetrics()
+
+    def extract_video(self, file_name):
+        output_path = self._video_path(file_name)
 
-        for index, (frame, tracks) in enumerate(self._get_frames_tracks(frames_dir, tracks_dir)):
-            frame = self.visualizer.draw_annotations(index, frame, tracks)
-            writer.write(frame)
+        if self._video_writer:
+            self._video_writer.release()
+            self._video_writer = None
 
-        writer.release()
+            if exists(output_path):
+                self.metrics.count('bytes_written', getsize(output_path))
 
         self.logger.newline()
         self.logger.info("Write totally processed video to '{}' file.".format(output_path))
 
-    def extract_events(self, file_name):
-        while self._events_queue:
-            events = self._events_queue.popleft()
+    async def cut_clips(self, input_path):
+        semaphore = asyncio.Semaphore(cpu_count() or 1)
+
+        async def cut_clip(start_time, duration, output_path):
+            # input seeking with stream copy starts clip from nearest keyframe, nothing is re-encoded:
+            ffmpeg = FFmpeg().option('y').input(input_path, ss=start_time, t=duration) \
+                .output(output_path, c='copy', avoid_negative_ts='make_zero')
+
+            async with semaphore:
+                await ffmpeg.execute()
 
-            frame_index = events[0]['frame_index']
+        with self.metrics.time('cut_clips'):
+            await asyncio.gather(*(cut_clip(*cut) for cut in self._cuts))
 
-            base_name = splitext(file_name)[0]
+        for _, _, output_path in self._cuts:
+            if exists(output_path):
+                self.metrics.count('bytes_written', getsize(output_path))
 
-            frames_dir = str(join(self.frames_root, base_name))
-            tracks_dir = str(join(self.tracks_root, base_name))
+        if self._cuts:
+            self.logger.newline()
+            self.logger.info("Cut {} event clip(s) from '{}' video.".format(len(self._cuts), input_path))
 
-            total_frames = len(listdir(frames_dir))
+        self._cuts = []
 
-            tracks_df = pd.DataFrame(columns=TRACKS_DF_COLUMNS, index=None)
+    def extract_events(self, file_name, final=False):
+        if self._frame_buffer and self._frame_buffer.last_index > self._last_index:
+            frame_index, frame = self._frame_buffer.last
 
-            for tracks_file_name in listdir(tracks_dir):
-                tracks = pd.read_csv(join(tracks_dir, tracks_file_name))
-                tracks_df = pd.concat([tracks_df, pd.DataFrame(tracks, columns=TRACKS_DF_COLUMNS)], ignore_index=True)
+            while self._events_queue:
+                events = self._events_queue.popleft()
 
-            for event in events:
-                track_id = event['track_id']
+                self.logger.newline()
+                self.logger.info("Extracting event(s) for frame {} to video:".format(events[0]['frame_index']))
 
-                req_track_df = tracks_df.loc[(tracks_df['track_id'] == track_id)]
-                start_frame_index = max(1, req_track_df['frame_index'].min() - self.frames_before)
-                end_frame_index = min(total_frames, req_track_df['frame_index'].max() + self.frames_after)
+                for event in events:
+                    self._open_clip(file_name, event)
 
-                if not exists(str(join(tracks_dir, '{}.csv'.format(end_frame_index)))):
-                    self._events_queue.appendleft(events)
-                    return
-                else:
-                    self.logger.newline()
-                    self.logger.info("Extracting event(s) for frame {} to video:".format(frame_index))
+            # every open clip and whole video get frame in single pass:
+            self._write_frame(file_name, frame_index, frame)
+            self._last_index = frame_index
 
-                    self._extract_event(file_name, event, req_track_df, start_frame_index, end_frame_index)
+        for clip in [clip for clip in self._clips if final or clip.end_index <= self._last_index]:
+            self._close_clip(clip)
 
-    def _extract_event(self, file_name, event, req_track_df, start_index, end_index):
+    def _open_clip(self, file_name, event):
         cur_index = event['frame_index']
         track_id = event['track_id']
-        event_name = event['event_name']
+        event_name = EVENT_NAMES[event['event_id']]
 
         base_name, extension = splitext(file_name)
-
-        frames_dir = str(join(self.frames_root, base_name))
         events_dir = str(join(self.events_root, base_name))
 
         if not exists(events_dir):
             mkdir(events_dir)
 
-        cur_frame = cv2.imread(join(frames_dir, '{}.png'.format(cur_index)))
-        frame_height, frame_width, _ = cur_frame.shape
-        frame_size = (frame_width, frame_height)
+        if self.clip_mode == COPIED_CLIPS:
+            output_path = join(events_dir, '{}-{}{}'.format(cur_index, track_id, extension))
+
+            # several events of one track in one frame share same clip:
+            if any(cut_path == output_path for _, _, cut_path in self._cuts):
+                return
+
+            start_index = max(cur_index - self.frames_before, 1)
+            end_index = cur_index + self.frames_after
+
+            self._cuts.append(((start_index - 1) / self.fps, (end_index - start_index + 1) / self.fps, output_path))
+            self.logger.info("Track ID - {}, event name - {}, file - {}.".format(track_id, event_name, output_path))
+
+            return
+
+        output_path = join(events_dir, '{}-{}{}'.format(cur_index, track_id, CLIP_EXTENSION))
+
+        if any(clip.output_path == output_path for clip in self._clips):
+            return
+
+        writer = ClipWriter(output_path, self.fps, self._frame_buffer.frame_size, self.clip_codec)
+
+        clip = EventClip(writer, output_path, event, cur_index + self.frames_after)
+
+        # frames before event are taken from buffer, event frame itself is written with others:
+        for index, frame in self._frame_buffer.frames(cur_index - self.frames_before, cur_index):
+            self._write_clip_frame(clip, index, frame)
+
+        self._clips.append(clip)
+
+    def _close_clip(self, clip):
+        clip.writer.release()
+        self._clips.remove(clip)
 
-        output_path = join(events_dir, '{}-{}{}'.format(cur_index, track_id, extension))
-        writer = cv2.VideoWriter(filename=output_path, fourcc=self.fourcc, fps=self.fps, frameSize=frame_size)
+        if exists(clip.output_path):
+            self.metrics.count('bytes_written', getsize(clip.output_path))
 
-        for index in range(start_index, end_index):
-            track = req_track_df.loc[(req_track_df['frame_index'] == index)]
-            frame = cv2.imread(join(frames_dir, '{}.png'.format(index)))
-            frame = self.visualizer.draw_annotations(index, frame, track)
+        self.logger.info("Track ID - {}, event name - {}, file - {}."
+                         .format(clip.track_id, clip.event_name, clip.output_path))
 
-            writer.write(frame)
+    def _write_frame(self, file_name, frame_index, frame):
+        for clip in self._clips:
+            self._write_clip_frame(clip, frame_index, frame)
 
-        writer.release()
+        # frames replayed for clips of resumed job are already in video:
+        if frame_index < self.video_start:
+            return
 
-        self.logger.info("Track ID - {}, event name - {}, file - {}.".format(track_id, event_name, output_path))
+        if self._video_writer is None:
+            self._video_writer = cv2.VideoWriter(filename=self._video_path(file_name), fourcc=self.fourcc,
+                                                 fps=self.fps, frameSize=self._frame_buffer.frame_size)
 
-    @staticmethod
-    def _get_frames_tracks(frames_dir, tracks_dir):
-        for frame_name, tracks_name in zip(sorted_listdir(frames_dir), sorted_listdir(tracks_dir)):
-            frame = cv2.imread(str(join(frames_dir, frame_name)))
-            tracks = pd.read_csv(str(join(tracks_dir, tracks_name)))
-            yield frame, tracks
+        tracks = self.track_store.frames(frame_index, frame_index + 1)
+
+        with self.metrics.time('annotate'):
+            frame = self.visualizer.draw_annotations(frame_index - 1, frame.copy(), tracks)
+
+        self._video_writer.write(frame)
+
+    def _write_clip_frame(self, clip, index, frame):
+        track = self.track_store.track(clip.track_id, index, index + 1)
+
+        with self.metrics.time('annotate'):
+            frame = self.visualizer.draw_annotations(index, frame.copy(), track)
+
+        clip.writer.write(frame)
+
+    def get_state(self):
+        # events of unfinished clips, their clips are written again from start after resume:
+        events = [clip.event for clip in self._clips] + [event for events in self._events_queue for event in events]
+        return {'events': np.array(events, dtype=EVENTS_DTYPE), 'cuts': list(self._cuts)}
+
+    def set_state(self, state, video_start):
+        self._cuts = list(state['cuts'])
+        self.video_start = video_start
+
+    def _video_path(self, file_name):
+        # rest of resumed video is written to separate file named by its first frame:
+        if self.video_start > 1:
+            base_name, extension = splitext(file_name)
+            file_name = '{}-{}{}'.format(base_name, self.video_start, extension)
+
+        return str(join(self.outputs_root, file_name))
 
     @property
     def events_queue(self):
         return self._events_queue
+
+    @property
+    def frame_buffer(self):
+        return self._frame_buffer
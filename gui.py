@@ -3,14 +3,13 @@ import requests
 import streamlit as st
 
 from fastapi import status
-from os.path import join, splitext
+from os.path import join, exists, splitext
 
-from ffmpeg import FFmpeg
+from constants import NEW_OBJECT, LINE_INTERSECTION, ZONE_ENTER, ZONE_EXIT, ANNOTATED_CLIPS, COPIED_CLIPS, \
+    CLIP_EXTENSION, TORCH_BACKEND, ONNX_BACKEND
 
-from ultralytics import YOLO
-
-from constants import NEW_OBJECT, LINE_INTERSECTION
 
+API_URL = 'http://127.0.0.1:8000'
 
 st.set_page_config(layout='wide')
 
@@ -24,14 +23,39 @@ if 'detector_name' not in st.session_state:
 if 'classes' not in st.session_state:
     st.session_state.classes = {}
 
+if 'job_id' not in st.session_state:
+    st.session_state.job_id = None
+
 
 def set_classes():
     ckpt_root = st.session_state.ckpt_root
     detector_name = st.session_state.detector_name
 
     if ckpt_root and detector_name:
-        ckpt_path = str(join(ckpt_root, detector_name.lower() + '.pt'))
-        st.session_state.classes = {value: key for key, value in dict(YOLO(ckpt_path).names).items()}
+        response = requests.get(url=API_URL + '/classes',
+                                params={'detector_name': detector_name.lower(), 'ckpt_root': ckpt_root},
+                                timeout=30)
+
+        if response.status_code == status.HTTP_200_OK:
+            st.session_state.classes = {value: int(key) for key, value in response.json().items()}
+
+
+def cancel_job():
+    if st.session_state.job_id:
+        requests.delete(url=API_URL + '/jobs/' + st.session_state.job_id, timeout=30)
+        st.session_state.job_id = None
+
+
+def stream_job_events(job_id):
+    # server-sent events are read line by line as job produces them:
+    response = requests.get(url=API_URL + '/jobs/{}/events'.format(job_id), stream=True, timeout=(30, None))
+    message_type = None
+
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith('event: '):
+            message_type = line[len('event: '):]
+        elif line.startswith('data: '):
+            yield message_type, json.loads(line[len('data: '):])
 
 
 def main():
@@ -49,7 +73,8 @@ def main():
 
         with column1:
             target_classes = st.multiselect(label="Target classes:", options=st.session_state.classes)
-            target_events = st.multiselect(label="Target events:", options=[NEW_OBJECT, LINE_INTERSECTION])
+            target_events = st.multiselect(label="Target events:",
+                                           options=[NEW_OBJECT, LINE_INTERSECTION, ZONE_ENTER, ZONE_EXIT])
 
         with column2:
             line_angle = st.number_input(label="Line angle (from -180 to 180 degrees):",
@@ -62,6 +87,9 @@ def main():
             with column22:
                 line_point_y = st.number_input(label="Line point Y:", value=None)
 
+            zones = st.text_area(label="Zones (JSON list of objects with 'name', 'kind' and 'points' keys):",
+                                 value='[]')
+
         with column3:
             sec_before = st.number_input(label="Time before object appearance (sec):",
                                          value=0, min_value=0, max_value=5)
@@ -74,11 +102,25 @@ def main():
         with column1:
             detector_name = st.selectbox(label="Detection model:", key='detector_name', on_change=set_classes,
                                          options=['YOLOv8-n', 'YOLOv8-s', 'YOLOv8-m', 'YOLOv8-l', 'YOLOv8-x'])
+            backend = st.selectbox(label="Detector backend:", options=[TORCH_BACKEND, ONNX_BACKEND])
+            int8 = st.checkbox(label="Quantize ONNX model to int8")
             frames_skip = st.number_input(label="Frames skip:", value=0, min_value=0, max_value=10)
+            adaptive_skip = st.checkbox(label="Adapt frames skip to scene activity")
+            realtime_factor = st.number_input(label="Target realtime factor (0 - unlimited):",
+                                              value=0.0, min_value=0.0, max_value=4.0, step=0.25)
+            segment_workers = st.number_input(label="Segment workers:", value=1, min_value=1, max_value=32)
+            detect_resolution = st.checkbox(label="Decode frames near input image size")
+            full_resolution = st.checkbox(label="Keep full resolution for output videos", value=True)
+            motion_gate = st.checkbox(label="Skip detection on static frames")
+            motion_sensitivity = st.number_input(label="Motion sensitivity (changed frame share):",
+                                                 value=0.002, min_value=0.0, max_value=1.0, step=0.001, format='%.3f')
 
         with column2:
             input_size = st.number_input(label="Input image size:",
                                          value=480, min_value=320, max_value=640, step=10)
+            roi_zones = st.checkbox(label="Detect objects only around zones")
+            tile_size = st.number_input(label="Tile size (0 - no tiling):",
+                                        value=0, min_value=0, max_value=1280, step=32)
             new_track_thresh = st.number_input(label="New track threshold:",
                                                value=0.6, min_value=0.0, max_value=1.0, step=0.05)
 
@@ -104,6 +146,7 @@ def main():
         with column2:
             ckpt_root = st.text_input(label="Model checkpoints:", key='ckpt_root')
             tracks_root = st.text_input(label="Object tracks:", value='tracks')
+            cache_root = st.text_input(label="Detection cache (empty - disabled):", value='')
 
         with column3:
             frames_root = st.text_input(label="Video frames:", value='frames')
@@ -113,8 +156,8 @@ def main():
         column1, column2, column3 = st.columns(3)
 
         with column1:
-            sql_dialect = st.selectbox(label="SQL dialect:", options=['postgresql'])
-            db_driver = st.selectbox(label="Database driver:", options=['psycopg2'])
+            sql_dialect = st.selectbox(label="SQL dialect:", options=['postgresql', 'sqlite'])
+            db_driver = st.selectbox(label="Database driver:", options=['psycopg2', 'pysqlite'])
 
         with column2:
             db_username = st.text_input(label="Username for database:", type='default', value='videoeventwatcher')
@@ -133,6 +176,7 @@ def main():
 
         with column2:
             fourcc = st.selectbox(label="FOURCC:", options=['XVID'])
+            clip_mode = st.selectbox(label="Event clips:", options=[ANNOTATED_CLIPS, COPIED_CLIPS])
 
         with column3:
             fps = st.number_input(label="FPS rate:", value=25, min_value=15, max_value=30)
@@ -152,11 +196,21 @@ def main():
                             'fps': fps,
 
                             'inputs_root': inputs_root,
-                            'frames_root': frames_root},
+                            'frames_root': frames_root,
+
+                            'cache_root': cache_root,
+
+                            'segment_workers': segment_workers,
+
+                            'detect_resolution': detect_resolution,
+                            'full_resolution': full_resolution},
 
                 'processor': {'detector_name': detector_name,
                               'input_size': input_size,
 
+                              'backend': backend,
+                              'int8': int8,
+
                               'tracks_root': tracks_root,
                               'ckpt_root': ckpt_root,
 
@@ -169,19 +223,31 @@ def main():
                               'frames_skip': frames_skip,
                               'target_labels': target_labels,
 
+                              'motion_gate': motion_gate,
+                              'motion_sensitivity': motion_sensitivity,
+
+                              'roi_zones': roi_zones,
+                              'tile_size': tile_size,
+
+                              'adaptive_skip': adaptive_skip,
+                              'realtime_factor': realtime_factor,
+                              'fps': fps,
+
                               'line_angle': line_angle,
-                              'line_point': line_point},
+                              'line_point': line_point,
+
+                              'zones': json.loads(zones)},
 
                 'extractor': {'outputs_root': outputs_root,
-                              'frames_root': frames_root,
-                              'tracks_root': tracks_root,
                               'events_root': events_root,
 
                               'sec_before': sec_before,
                               'sec_after': sec_after,
 
                               'fourcc': fourcc,
-                              'fps': fps},
+                              'fps': fps,
+
+                              'clip_mode': clip_mode},
 
                 'saver': {'sql_dialect': sql_dialect,
                           'db_driver': db_driver,
@@ -193,38 +259,58 @@ def main():
                           'db_name': db_name}
             }
 
-            response = requests.post(url='http://127.0.0.1:8000/watch',
+            response = requests.post(url=API_URL + '/jobs',
                                      json={'config': config, 'filename': video_object.name},
-                                     timeout=900)
+                                     timeout=30)
 
             if response.status_code == status.HTTP_200_OK:
+                st.session_state.job_id = response.json()['job_id']
+                st.button(label="Cancel watching", on_click=cancel_job, use_container_width=True)
+
+                progress = st.empty()
                 st.markdown(body="#### Events:")
 
                 column1, column2 = st.columns(2)
+                expanders = []
+
+                for message_type, data in stream_job_events(st.session_state.job_id):
+                    if message_type == 'progress':
+                        progress.markdown(body="Processed frames - {}, speed - {} FPS."
+                                          .format(data['frames_count'], data['fps']))
+
+                    elif message_type == 'event':
+                        column = column2 if len(expanders) % 2 else column1
+
+                        frame_index = data['frame_index']
+                        track_id = data['track_id']
+                        event_name = data['event_name']
+
+                        event_description = ('Frame - {}, track ID - {}, event name - {}.'
+                                             .format(frame_index, track_id, event_name))
 
-                events = json.loads(response.content)
+                        with column:
+                            expanders.append((frame_index, track_id, st.expander(label=event_description)))
 
-                for index, event in enumerate(events):
-                    column = column2 if index % 2 else column1
+                    elif message_type == 'status':
+                        progress.markdown(body="Job status - {}, processed frames - {}, speed - {} FPS."
+                                          .format(data['status'], data['frames_count'], data['fps']))
 
-                    frame_index = event['frame_index']
-                    track_id = event['track_id']
-                    event_name = event['event_name']
+                        if data['error']:
+                            st.error(body=data['error'])
 
-                    event_description = ('Frame - {}, track ID - {}, event name - {}.'
-                                         .format(frame_index, track_id, event_name))
+                st.session_state.job_id = None
 
-                    raw_event_path = str(join(events_root, splitext(video_object.name)[0], '{}-{}.avi'
-                                              .format(frame_index, track_id)))
-                    converted_event_path = raw_event_path.replace('.avi', '.mp4')
+                # copied clips keep source container, annotated ones are already browser-playable:
+                base_name, extension = splitext(video_object.name)
+                extension = extension if clip_mode == COPIED_CLIPS else CLIP_EXTENSION
 
-                    ffmpeg = FFmpeg().option('y').input(raw_event_path).output(converted_event_path, vcodec='libx264')
-                    ffmpeg.execute()
+                # clips are complete only when job is over:
+                for frame_index, track_id, expander in expanders:
+                    event_path = str(join(events_root, base_name, '{}-{}{}'.format(frame_index, track_id, extension)))
 
-                    with column:
-                        with st.expander(label=event_description):
-                            with open(converted_event_path, 'rb') as event_object:
-                                st.video(event_object.read())
+                    if exists(event_path):
+                        with open(event_path, 'rb') as event_object:
+                            expander.video(event_object.read())
 
         st.divider()
 
@@ -0,0 +1,161 @@
+import json
+import asyncio
+
+from uuid import uuid4
+from time import monotonic
+from collections import OrderedDict
+
+from constants import JOB_PENDING, JOB_RUNNING, JOB_DONE, JOB_FAILED, JOB_CANCELLED
+from utils import create_logger, event_dicts
+
+
+class WatchJob:
+    def __init__(self, file_name):
+        self.job_id = uuid4().hex
+        self.file_name = file_name
+        self.zone_names = ()
+
+        self.status = JOB_PENDING
+        self.error = None
+
+        self.events = []
+        self.frames_count = 0
+
+        self.metrics = None
+
+        self.task = None
+
+        self._start_time = None
+        self._end_time = None
+
+        # every update completes current event and replaces it, so each subscriber wakes up once:
+        self._changed = asyncio.Event()
+
+    def start(self, zone_names, metrics=None):
+        self.zone_names = zone_names
+        self.metrics = metrics
+        self.status = JOB_RUNNING
+        self._start_time = monotonic()
+        self._notify()
+
+    def update(self, frames_count, events):
+        self.frames_count = frames_count
+        self.events.extend(event_dicts(events, self.file_name, self.zone_names))
+        self._notify()
+
+    def finish(self, status, error=None):
+        self.status = status
+        self.error = error and str(error)
+        self._end_time = monotonic()
+        self._notify()
+
+    async def stream(self):
+        sent_events = 0
+        sent_frames = None
+
+        while True:
+            changed = self._changed
+
+            for event in self.events[sent_events:]:
+                yield self._message('event', event)
+
+            sent_events = len(self.events)
+
+            # progress is sent once per wake up, so slow clients skip intermediate values:
+            if self.frames_count != sent_frames:
+                sent_frames = self.frames_count
+                yield self._message('progress', {'frames_count': self.frames_count, 'fps': self.fps})
+
+            if self.finished:
+                yield self._message('status', self.info())
+                return
+
+            await changed.wait()
+
+    def info(self):
+        info = {'job_id': self.job_id,
+                'file_name': self.file_name,
+                'status': self.status,
+                'error': self.error,
+                'frames_count': self.frames_count,
+                'events_count': len(self.events),
+                'fps': self.fps}
+
+        if self.metrics and self.metrics.enabled:
+            info['metrics'] = self.metrics.summary()
+
+        return info
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    @staticmethod
+    def _message(message_type, data):
+        return 'event: {}\ndata: {}\n\n'.format(message_type, json.dumps(data))
+
+    @property
+    def fps(self):
+        if self._start_time is None:
+            return 0.0
+
+        elapsed_time = (self._end_time or monotonic()) - self._start_time
+        return round(self.frames_count / elapsed_time, 2) if elapsed_time else 0.0
+
+    @property
+    def finished(self):
+        return self.status in (JOB_DONE, JOB_FAILED, JOB_CANCELLED)
+
+
+class JobManager:
+    logger = create_logger(__name__)
+
+    def __init__(self, max_jobs, max_finished):
+        self.max_finished = max_finished
+
+        # jobs over limit wait for free slot in pending state:
+        self._semaphore = asyncio.Semaphore(max_jobs)
+        self._jobs = OrderedDict()
+
+    def submit(self, file_name, watch):
+        job = WatchJob(file_name)
+        job.task = asyncio.create_task(self._run(job, watch))
+
+        self._jobs[job.job_id] = job
+        self._prune()
+
+        self.logger.info("Submit job {} for '{}' video.".format(job.job_id, file_name))
+
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self._jobs.get(job_id)
+
+        if job and not job.finished:
+            job.task.cancel()
+
+        return job
+
+    async def _run(self, job, watch):
+        try:
+            async with self._semaphore:
+                await watch(job)
+        except asyncio.CancelledError:
+            job.finish(JOB_CANCELLED)
+        except Exception as error:
+            self.logger.error("Job {} failed: {}.".format(job.job_id, error))
+            job.finish(JOB_FAILED, error)
+        else:
+            job.finish(JOB_DONE)
+
+        self.logger.info("Job {} for '{}' video is {}.".format(job.job_id, job.file_name, job.status))
+
+    def _prune(self):
+        finished_ids = [job_id for job_id, job in self._jobs.items() if job.finished]
+
+        # oldest finished jobs are forgotten first:
+        for job_id in finished_ids[:max(len(finished_ids) - self.max_finished, 0)]:
+            del self._jobs[job_id]
@@ -1,19 +1,82 @@
+import asyncio
+
+from os import environ
+from os.path import join, split, splitext
+from contextlib import asynccontextmanager
+
 from omegaconf import DictConfig
 
-from fastapi import FastAPI
-from fastapi.responses import RedirectResponse
+from fastapi import FastAPI, HTTPException, status
+from fastapi.responses import RedirectResponse, StreamingResponse, PlainTextResponse
 
 from visualizer import EventVisualizer
 from processor import FrameProcessor
 from extractor import EventExtractor
 from saver import EventSaver
+from tracks import TrackStore
+from detector import registry
+from metrics import registry as metrics_registry
 
 from watcher import EventWatcher
+from jobs import JobManager
 
 from models import RequestData
+from constants import MAX_JOBS, MAX_FINISHED_JOBS, SHARED_BATCH, SHARED_LATENCY
+from utils import event_dicts
+
+
+@asynccontextmanager
+async def lifespan(_):
+    # comma-separated checkpoint paths, e.g. '/models/yolov8/yolov8-n.pt,/models/yolov8/yolov8-s.pt':
+    for checkpoint_path in filter(None, environ.get('WARMUP_DETECTORS', '').split(',')):
+        ckpt_root, checkpoint_name = split(checkpoint_path.strip())
+        registry.warm_up(splitext(checkpoint_name)[0], ckpt_root)
+
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+
+# number of videos watched concurrently, other jobs wait in queue:
+jobs = JobManager(int(environ.get('MAX_JOBS', MAX_JOBS)), MAX_FINISHED_JOBS)
+
+# frames of concurrent jobs go to shared detector batches, 1 disables batching across jobs:
+shared_batch = int(environ.get('SHARED_BATCH', SHARED_BATCH))
+shared_latency = float(environ.get('SHARED_LATENCY', SHARED_LATENCY))
+
 
+async def create_watcher(config, file_name):
+    tracks_path = str(join(config.processor.tracks_root, splitext(file_name)[0] + '.tracks'))
+    # tracks of long videos are kept in memory only for recent frames, clips still need ones before event:
+    tracks_window = config.processor.tracks_window and max(config.processor.tracks_window,
+                                                           config.extractor.sec_before * config.extractor.fps
+                                                           + config.processor.batch_size + 1)
 
-app = FastAPI()
+    track_store = TrackStore(tracks_path if config.processor.tracks_flush else None, config.processor.tracks_flush,
+                             max_frames=tracks_window)
+
+    # checkpoint loading must not block other jobs:
+    detector = await asyncio.get_running_loop().run_in_executor(None, registry.get_shared,
+                                                                config.processor.detector_name,
+                                                                config.processor.ckpt_root, config.processor.backend,
+                                                                config.processor.int8, config.processor.threads,
+                                                                shared_batch, shared_latency)
+
+    processor = FrameProcessor(config.processor, detector, track_store)
+    visualizer = EventVisualizer(processor.zones)
+    extractor = EventExtractor(config.extractor, visualizer, track_store)
+    saver = EventSaver(config.saver)
+
+    return EventWatcher(config.watcher, processor, extractor, saver)
+
+
+def get_job(job_id):
+    job = jobs.get(job_id)
+
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job '{}' not found.".format(job_id))
+
+    return job
 
 
 @app.get('/', response_class=RedirectResponse)
@@ -21,17 +84,63 @@ async def redirect_docs():
     return RedirectResponse(url='/docs')
 
 
+@app.get('/classes')
+async def get_classes(detector_name: str, ckpt_root: str):
+    # checkpoint of unseen model is read without blocking event loop:
+    return await asyncio.get_running_loop().run_in_executor(None, registry.get_names, detector_name, ckpt_root)
+
+
+@app.get('/metrics', response_class=PlainTextResponse)
+async def get_metrics():
+    # Prometheus text format, jobs without enabled metrics are not exposed:
+    return metrics_registry.exposition()
+
+
 @app.post('/watch')
 async def produce_events(request_data: RequestData):
     config = DictConfig(request_data.config.model_dump())
 
-    visualizer = EventVisualizer(config.processor.line_angle, config.processor.line_point)
+    watcher = await create_watcher(config, request_data.filename)
+    events = await watcher.watch_events(request_data.filename)
 
-    processor = FrameProcessor(config.processor)
-    extractor = EventExtractor(config.extractor, visualizer)
-    saver = EventSaver(config.saver)
+    events = event_dicts(events, request_data.filename, watcher.processor.zones.names)
 
-    watcher = EventWatcher(config.watcher, processor, extractor, saver)
-    events = await watcher.watch_events(request_data.filename)
+    # stage timings summary comes along with events when metrics are enabled:
+    if watcher.metrics.enabled:
+        return {'events': events, 'metrics': watcher.metrics.summary()}
 
     return events
+
+
+@app.post('/jobs')
+async def submit_job(request_data: RequestData):
+    config = DictConfig(request_data.config.model_dump())
+
+    async def watch(job):
+        watcher = await create_watcher(config, job.file_name)
+        watcher.metrics.job_name = job.job_id
+
+        job.start(watcher.processor.zones.names, watcher.metrics)
+
+        await watcher.watch_events(job.file_name, job.update)
+
+    return jobs.submit(request_data.filename, watch).info()
+
+
+@app.get('/jobs/{job_id}')
+async def get_job_status(job_id: str):
+    return get_job(job_id).info()
+
+
+@app.get('/jobs/{job_id}/events')
+async def stream_job_events(job_id: str):
+    # server-sent events: found events, progress and final status:
+    return StreamingResponse(get_job(job_id).stream(), media_type='text/event-stream')
+
+
+@app.delete('/jobs/{job_id}')
+async def cancel_job(job_id: str):
+    job = get_job(job_id)
+    jobs.cancel(job_id)
+
+    return job.info()
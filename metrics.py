@@ -0,0 +1,188 @@
+from time import perf_counter
+from bisect import bisect_left
+from threading import Lock
+from contextlib import nullcontext
+from collections import OrderedDict
+
+from constants import METRICS_BUCKETS, METRICS_PREFIX, MAX_FINISHED_JOBS
+from utils import create_logger
+
+
+class Histogram:
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        # last bucket counts values above largest bound:
+        self.counts = [0] * (len(METRICS_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(METRICS_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        cumulative = 0
+
+        # upper bound of bucket that holds the rank, values above largest bound are reported as it:
+        for bound, count in zip(METRICS_BUCKETS, self.counts):
+            cumulative += count
+
+            if cumulative >= rank:
+                return bound
+
+        return METRICS_BUCKETS[-1]
+
+
+class StageTimer:
+    __slots__ = ('metrics', 'stage', 'start_time')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = perf_counter()
+
+    def __exit__(self, *_):
+        self.metrics.observe(self.stage, perf_counter() - self.start_time)
+
+
+class JobMetrics:
+    logger = create_logger(__name__)
+
+    # shared by disabled instances, so timing costs nothing when metrics are off:
+    _null_timer = nullcontext()
+
+    def __init__(self, enabled=False, job_name=''):
+        self.enabled = enabled
+        self.job_name = job_name
+
+        self.histograms = {}
+        self.counters = {}
+
+        # saver updates metrics from its writer thread:
+        self._lock = Lock()
+
+    def time(self, stage):
+        return StageTimer(self, stage) if self.enabled else self._null_timer
+
+    def timed(self, stage, async_iterable, counter=None):
+        return self._timed(stage, async_iterable, counter) if self.enabled else async_iterable
+
+    async def _timed(self, stage, async_iterable, counter):
+        iterator = async_iterable.__aiter__()
+
+        # time spent waiting for every next item is observed, e.g. decoding of next frame:
+        while True:
+            start_time = perf_counter()
+
+            try:
+                item = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+
+            self.observe(stage, perf_counter() - start_time)
+
+            if counter:
+                self.count(counter)
+
+            yield item
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram()
+
+            self.histograms[stage].observe(seconds)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        return {'counters': dict(self.counters),
+                'stages': {stage: {'count': histogram.count,
+                                   'total': round(histogram.total, 4),
+                                   'mean': round(histogram.total / histogram.count, 4),
+                                   'p50': histogram.quantile(0.5),
+                                   'p95': histogram.quantile(0.95)}
+                           for stage, histogram in self.histograms.items()}}
+
+    def log_summary(self):
+        self.logger.newline()
+        self.logger.info("Stage timings of '{}' job:".format(self.job_name))
+
+        for stage, histogram in sorted(self.histograms.items(), key=lambda item: item[1].total, reverse=True):
+            self.logger.info("Stage - {}, calls - {}, total - {:.3f} s, mean - {:.2f} ms, p95 - {} s."
+                             .format(stage, histogram.count, histogram.total, 1000 * histogram.total / histogram.count,
+                                     histogram.quantile(0.95)))
+
+        for name, value in sorted(self.counters.items()):
+            self.logger.info("Counter - {}, value - {}.".format(name, value))
+
+
+class MetricsRegistry:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._metrics = OrderedDict()
+
+    def add(self, metrics):
+        if not metrics.enabled:
+            return
+
+        self._metrics[id(metrics)] = metrics
+
+        # oldest jobs are forgotten first:
+        while len(self._metrics) > self.max_size:
+            self._metrics.popitem(last=False)
+
+    def exposition(self):
+        # Prometheus text format, every job is labelled by its name:
+        histogram_lines, counter_lines = [], {}
+
+        for metrics in list(self._metrics.values()):
+            job_label = 'job="{}"'.format(metrics.job_name.replace('\\', '\\\\').replace('"', '\\"'))
+
+            with metrics._lock:
+                histograms = list(metrics.histograms.items())
+                counters = list(metrics.counters.items())
+
+            for stage, histogram in histograms:
+                labels = '{},stage="{}"'.format(job_label, stage)
+                cumulative = 0
+
+                for bound, count in zip(METRICS_BUCKETS + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    histogram_lines.append('{}_stage_seconds_bucket{{{},le="{}"}} {}'
+                                           .format(METRICS_PREFIX, labels, '+Inf' if bound == float('inf')
+                                                   else bound, cumulative))
+
+                histogram_lines.append('{}_stage_seconds_sum{{{}}} {}'.format(METRICS_PREFIX, labels, histogram.total))
+                histogram_lines.append('{}_stage_seconds_count{{{}}} {}'.format(METRICS_PREFIX, labels,
+                                                                               histogram.count))
+
+            for name, value in counters:
+                counter_lines.setdefault(name, []).append('{}_{}_total{{{}}} {}'.format(METRICS_PREFIX, name,
+                                                                                       job_label, value))
+
+        lines = ['# HELP {}_stage_seconds Latency of pipeline stages.'.format(METRICS_PREFIX),
+                 '# TYPE {}_stage_seconds histogram'.format(METRICS_PREFIX)] + histogram_lines
+
+        for name, metric_lines in sorted(counter_lines.items()):
+            lines.append('# TYPE {}_{}_total counter'.format(METRICS_PREFIX, name))
+            lines.extend(metric_lines)
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry(MAX_FINISHED_JOBS)
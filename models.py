@@ -2,6 +2,12 @@ from pydantic import BaseModel
 from typing import List, Optional
 
 
+class ZoneConfig(BaseModel):
+    name: str
+    kind: str
+    points: List[List[int]]
+
+
 class WatcherConfig(BaseModel):
     target_events: List[str]
 
@@ -11,13 +17,39 @@ class WatcherConfig(BaseModel):
     inputs_root: str
     frames_root: str
 
+    streaming: bool = True
+    decode_buffer: int = 32
+
+    detect_resolution: bool = False
+    full_resolution: bool = True
+
+    cache_root: str = ''
+    cache_size: int = 1024
+    cache_tracks: bool = True
+
+    metrics: bool = False
+    profile_root: str = ''
+
+    checkpoint_root: str = ''
+    checkpoint_interval: int = 1500
+
+    segment_workers: int = 1
+    segment_overlap: int = 25
+    segment_iou: float = 0.5
+
 
 class ProcessorConfig(BaseModel):
     detector_name: str
     input_size: int
 
+    backend: str = 'torch'
+    int8: bool = False
+    threads: int = 0
+
     ckpt_root: str
     tracks_root: str
+    tracks_flush: int = 0
+    tracks_window: int = 3000
 
     track_buffer: int
     match_thresh: float
@@ -25,17 +57,36 @@ class ProcessorConfig(BaseModel):
     track_low_thresh: float
     track_high_thresh: float
 
+    batch_size: int = 1
     frames_skip: int
     target_labels: List[int]
 
+    motion_gate: bool = False
+    motion_sensitivity: float = 0.002
+
+    adaptive_skip: bool = False
+    max_frames_skip: int = 10
+    busy_tracks: int = 5
+    line_margin: int = 64
+    realtime_factor: float = 0.0
+    fps: int = 25
+
+    roi: Optional[List[int]] = None
+    roi_zones: bool = False
+    roi_margin: int = 64
+
+    tile_size: int = 0
+    tile_overlap: float = 0.25
+
     line_angle: Optional[int]
     line_point: Optional[List[int]]
 
+    zones: List[ZoneConfig] = []
+    zones_cell: int = 128
+
 
 class ExtractorConfig(BaseModel):
     outputs_root: str
-    frames_root: str
-    tracks_root: str
     events_root: str
 
     sec_before: int
@@ -44,17 +95,23 @@ class ExtractorConfig(BaseModel):
     fourcc: str
     fps: int
 
+    clip_mode: str = 'annotated'
+    clip_codec: str = 'libx264'
+
 
 class SaverConfig(BaseModel):
     sql_dialect: str
-    db_driver: str
+    db_driver: str = ''
 
-    db_username: str
-    db_password: str
+    db_username: str = ''
+    db_password: str = ''
 
-    host_name: str
+    host_name: str = ''
     db_name: str
 
+    batch_size: int = 256
+    flush_interval: float = 1.0
+
 
 class Config(BaseModel):
     watcher: WatcherConfig
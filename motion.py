@@ -0,0 +1,42 @@
+import cv2
+import numpy as np
+
+from constants import MOTION_WIDTH, MOTION_PIXEL_THRESH
+
+
+class MotionGate:
+    def __init__(self, sensitivity, width=MOTION_WIDTH, pixel_thresh=MOTION_PIXEL_THRESH):
+        # share of changed pixels which counts as motion:
+        self.sensitivity = sensitivity
+
+        self.width = width
+        self.pixel_thresh = pixel_thresh
+
+        self._reference = None
+
+        self.checked_frames = 0
+        self.skipped_frames = 0
+
+    def check(self, frame, force=False):
+        frame_height, frame_width = frame.shape[:2]
+        frame_size = (self.width, max(frame_height * self.width // frame_width, 1))
+
+        small_frame = cv2.resize(frame, frame_size, interpolation=cv2.INTER_AREA)
+        small_frame = cv2.GaussianBlur(cv2.cvtColor(small_frame, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+
+        self.checked_frames += 1
+
+        if not force and self._reference is not None and self._reference.shape == small_frame.shape:
+            changed_pixels = np.count_nonzero(cv2.absdiff(small_frame, self._reference) > self.pixel_thresh)
+
+            # frame is compared with last detected one, so slow motion accumulates until it passes threshold:
+            if changed_pixels <= self.sensitivity * small_frame.size:
+                self.skipped_frames += 1
+                return False
+
+        self._reference = small_frame
+        return True
+
+    @property
+    def skip_rate(self):
+        return self.skipped_frames / self.checked_frames if self.checked_frames else 0.0
@@ -1,115 +1,492 @@
 import torch
-import asyncio
 import numpy as np
-import pandas as pd
 
-from os import mkdir
+from math import ceil
+from time import perf_counter
 from datetime import datetime
 from argparse import Namespace
-from os.path import exists, join, splitext
 
-from ultralytics import YOLO
+from ultralytics.engine.results import Boxes
+from ultralytics.trackers.basetrack import BaseTrack
 from ultralytics.trackers.byte_tracker import BYTETracker
 
-from constants import NEW_OBJECT, LINE_INTERSECTION, TRACKS_DF_COLUMNS, DATETIME_FMT, INTERSECT_THRESH, DELAY_TIME
-from utils import create_logger, get_line_coefficients
+from zones import Zones
+from motion import MotionGate
+from tracks import TrackState
+from metrics import JobMetrics
+from constants import NEW_OBJECT, LINE_INTERSECTION, ZONE_ENTER, ZONE_EXIT, EVENT_NAMES, EVENTS_DTYPE, \
+    TILES_MERGE_THRESH
+from utils import create_logger
+
+
+def _merge_boxes(data, tiles, regions, thresh):
+    regions = np.array(regions, dtype=np.float32)
+    areas = (data[:, 2] - data[:, 0]) * (data[:, 3] - data[:, 1])
+    merged = np.zeros(len(data), dtype=bool)
+    result = []
+
+    # most confident and largest boxes go first:
+    for pos in np.lexsort((-areas, -data[:, 4])):
+        if merged[pos]:
+            continue
+
+        widths = np.minimum(data[pos, 2], data[:, 2]) - np.maximum(data[pos, 0], data[:, 0])
+        heights = np.minimum(data[pos, 3], data[:, 3]) - np.maximum(data[pos, 1], data[:, 1])
+        intersections = np.clip(widths, 0, None) * np.clip(heights, 0, None)
+
+        # shared area of box tile and tile of every other box, empty for tiles that do not overlap:
+        shared = np.concatenate([np.maximum(regions[tiles[pos], :2], regions[tiles, :2]),
+                                 np.minimum(regions[tiles[pos], 2:], regions[tiles, 2:])], axis=1)
+
+        in_shared = (shared[:, 0] < shared[:, 2]) & (shared[:, 1] < shared[:, 3]) & \
+            (data[:, 0] < shared[:, 2]) & (data[:, 2] > shared[:, 0]) & \
+            (data[:, 1] < shared[:, 3]) & (data[:, 3] > shared[:, 1]) & \
+            (data[pos, 0] < shared[:, 2]) & (data[pos, 2] > shared[:, 0]) & \
+            (data[pos, 1] < shared[:, 3]) & (data[pos, 3] > shared[:, 1])
+
+        # parts of object cut by tile border are mostly covered by its box from neighbouring tile,
+        # boxes of one tile are already suppressed by detector:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            candidates = ~merged & (tiles != tiles[pos]) & (data[:, 5] == data[pos, 5]) & in_shared & \
+                (intersections > thresh * np.minimum(areas[pos], areas))
+
+        group = np.zeros(len(data), dtype=bool)
+        group[pos] = True
+
+        # only best matching box of every neighbouring tile is the same object:
+        for tile in np.unique(tiles[candidates]):
+            tile_positions = np.flatnonzero(candidates & (tiles == tile))
+            group[tile_positions[np.argmax(intersections[tile_positions])]] = True
+
+        merged |= group
+
+        box = data[pos].copy()
+        box[:2], box[2:4] = data[group, :2].min(axis=0), data[group, 2:4].max(axis=0)
+
+        result.append(box)
+
+    return np.array(result, dtype=np.float32).reshape(-1, data.shape[1])
 
 
 class FrameProcessor:
     logger = create_logger(__name__)
 
-    def __init__(self, config):
-        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
-
-        checkpoint_path = str(join(config.ckpt_root, config.detector_name + '.pt'))
+    def __init__(self, config, detector, track_store):
+        self.config = config
 
         self.input_size = config.input_size
-        self.tracks_root = config.tracks_root
+        self.track_store = track_store
 
-        self.detector = YOLO(model=checkpoint_path, verbose=False)
-        self.detector.to(self.device)
+        self.detector = detector
 
         tracker_args = Namespace(track_buffer=config.track_buffer,
                                  match_thresh=config.match_thresh,
                                  new_track_thresh=config.new_track_thresh,
                                  track_low_thresh=config.track_low_thresh,
-                                 track_high_thresh=config.track_high_thresh)
+                                 track_high_thresh=config.track_high_thresh,
+                                 fuse_score=True)
 
         self.tracker = BYTETracker(tracker_args)
-        self.total_tracks = set()
-        self.last_tracks = []
+        self.zones = Zones.from_config(config)
 
+        # last observed position of each track and polygon zones it is inside of:
+        self.track_states = TrackState(first_frame=(np.int32, 0), last_frame=(np.int32, 0),
+                                       last_x=(np.int32, 0), last_y=(np.int32, 0),
+                                       inside=(np.bool_, False, (len(self.zones.polygon_ids),)))
+
+        # tracker forgets lost tracks after track_buffer updates, which are at most largest stride apart:
+        max_frames_skip = max(config.frames_skip, config.max_frames_skip) if config.adaptive_skip \
+            else config.frames_skip
+
+        self.track_ttl = config.track_buffer * (max_frames_skip + 1)
+
+        # detection frames may be smaller than source ones, boxes are mapped back with this scale:
+        self.box_scale = np.ones(4)
+
+        self.last_tracks = np.empty((0, 8))
+
+        # boxes of skipped frames are extrapolated with per frame velocities since last detection:
+        self.last_velocities = np.zeros((0, 4))
+        self.last_detect_index = None
+
+        self.batch_size = config.batch_size
         self.frames_skip = config.frames_skip
         self.target_labels = config.target_labels
 
-        self.line_angle = config.line_angle
-        self.line_point = config.line_point
+        self.motion_gate = MotionGate(config.motion_sensitivity) if config.motion_gate else None
 
-    async def process_frame(self, file_name, index, frame):
-        base_name = splitext(file_name)[0]
-        tracks_dir = str(join(self.tracks_root, base_name))
+        self.adaptive_skip = config.adaptive_skip
+        self.max_frames_skip = config.max_frames_skip
+        self.busy_tracks = config.busy_tracks
+        self.line_margin = config.line_margin
 
-        if not exists(tracks_dir):
-            mkdir(tracks_dir)
+        # detector time per frame must fit into frame interval divided by realtime factor:
+        self.realtime_factor = config.realtime_factor
+        self.fps = config.fps
 
-        tracks = await self._get_tracks(index, frame)
-        self._dump_tracks(tracks, tracks_dir)
-        events = self._find_events(file_name, tracks)
+        self.detect_time = 0.0
+        self.next_detect_index = 0
 
-        return events
+        # region of interest is set explicitly or covers all zones, in source coordinates:
+        if config.roi:
+            self.roi = np.array(config.roi, dtype=float)
+        elif config.roi_zones and len(self.zones):
+            points = np.concatenate(self.zones.points)
+            self.roi = np.concatenate([points.min(axis=0) - config.roi_margin, points.max(axis=0) + config.roi_margin])
+        else:
+            self.roi = None
+
+        self.tile_size = config.tile_size
+        self.tile_overlap = config.tile_overlap
+
+        # detection regions of each frame size:
+        self._regions = {}
+
+        # detections by frame index loaded from cache, ones found in this run are spilled to disk:
+        self.cached_detections = {}
+        self.detections_spill = None
+
+        # disabled unless watcher shares its job metrics:
+        self.metrics = JobMetrics()
+
+    def get_state(self):
+        # tracker IDs come from global counter, new tracks of resumed job must not reuse them:
+        return {'tracker': self.tracker,
+                'track_count': BaseTrack._count,
+                'track_states': self.track_states,
+                'last_tracks': self.last_tracks,
+                'last_velocities': self.last_velocities,
+                'last_detect_index': self.last_detect_index,
+                'next_detect_index': self.next_detect_index,
+                'detect_time': self.detect_time,
+                'motion_gate': self.motion_gate}
+
+    def set_state(self, state):
+        self.tracker = state['tracker']
+        BaseTrack._count = max(BaseTrack._count, state['track_count'])
+
+        self.track_states = state['track_states']
+
+        self.last_tracks = state['last_tracks']
+        self.last_velocities = state['last_velocities']
+        self.last_detect_index = state['last_detect_index']
+        self.next_detect_index = state['next_detect_index']
+        self.detect_time = state['detect_time']
+
+        self.motion_gate = state['motion_gate']
+
+    async def process_frame(self, index, frame):
+        events = await self.process_frames([index], [frame])
+        return events[0]
+
+    async def process_frames(self, indices, frames):
+        batch_tracks = await self.get_tracks(indices, frames)
+        return [self.process_tracks(index, tracks) for index, tracks in zip(indices, batch_tracks)]
+
+    def process_tracks(self, index, tracks):
+        self.track_store.append(index + 1, tracks)
+
+        with self.metrics.time('events'):
+            return self._find_events(index + 1, tracks)
+
+    async def get_tracks(self, indices, frames):
+        if self.adaptive_skip:
+            return await self._adaptive_tracks(indices, frames)
+
+        detect_positions = [pos for pos, index in enumerate(indices) if not index % (self.frames_skip + 1)]
+        detections = await self._get_detections(indices, frames, detect_positions)
+
+        with self.metrics.time('track'):
+            return self._update_tracker(indices, detections)
+
+    async def _adaptive_tracks(self, indices, frames):
+        tracks, detections, planned = [], {}, set()
+
+        # stride is re-evaluated after every tracker update, rest of batch is planned again when it shrinks:
+        while len(tracks) < len(indices):
+            start = len(tracks)
+            detect_positions = [start + pos for pos in self._adaptive_positions(indices[start:])]
+
+            planned.update(detect_positions)
+            detections.update(await self._get_detections(indices, frames, [pos for pos in detect_positions
+                                                                           if pos not in detections]))
+
+            with self.metrics.time('track'):
+                tracks.extend(self._update_tracker(indices, detections, start, planned))
+
+        return tracks
+
+    async def _get_detections(self, indices, frames, detect_positions):
+        detections = {}
+
+        if self.motion_gate:
+            detect_positions = self._gate_positions(detect_positions, frames)
+
+        # cached frames are replayed, detector gets only the rest:
+        for pos in detect_positions:
+            if indices[pos] in self.cached_detections:
+                detections[pos] = Boxes(self.cached_detections[indices[pos]], frames[pos].shape[:2])
+
+        self.metrics.count('cached_frames', len(detections))
+
+        detect_positions = [pos for pos in detect_positions if pos not in detections]
+
+        if detect_positions:
+            start_time = perf_counter()
+
+            with self.metrics.time('detect'):
+                batch_detections = await self._detect([frames[pos] for pos in detect_positions])
+
+            detections.update(zip(detect_positions, batch_detections))
+
+            self.metrics.count('detector_calls')
+            self.metrics.count('detected_frames', len(detect_positions))
+
+            if self.detections_spill is not None:
+                for pos, boxes in zip(detect_positions, batch_detections):
+                    self.detections_spill.append(indices[pos], boxes.data[:, :6])
+
+            # moving average of detector time per frame:
+            frame_time = (perf_counter() - start_time) / len(detect_positions)
+            self.detect_time = frame_time if not self.detect_time else 0.9 * self.detect_time + 0.1 * frame_time
+
+        return detections
+
+    def _update_tracker(self, indices, detections, start=0, planned=None):
+        tracks = []
 
-    async def _get_tracks(self, index, frame):
-        if index % (self.frames_skip + 1):
-            result_tracks = self.last_tracks
+        # tracker is updated strictly in frame order:
+        for pos in range(start, len(indices)):
+            index = indices[pos]
+
+            # frame became due after stride shrank, so it is planned again:
+            if planned is not None and pos not in planned and index >= self.next_detect_index:
+                break
+
+            if pos not in detections:
+                result_tracks = self._extrapolate_tracks(index)
+                self.metrics.count('skipped_frames')
+            else:
+                result_tracks = self.tracker.update(detections[pos])
+
+                # to get around tracker mysterious bug:
+                if result_tracks.any():
+                    self._update_velocities(index, result_tracks)
+                    self.last_tracks = result_tracks
+                else:
+                    self.last_velocities = np.zeros((len(self.last_tracks), 4))
+                    result_tracks = self.last_tracks
+
+                self.last_detect_index = index
+
+                # new tracks need next detections soon, or tracker loses them:
+                if self.adaptive_skip:
+                    self.next_detect_index = index + self._adaptive_frames_skip() + 1
+
+            result_tracks = np.insert(result_tracks, 0, index + 1, 1)[:, :6]
+            result_tracks[:, 1:5] *= self.box_scale
+
+            tracks.append(result_tracks.astype('int'))
+
+        return tracks
+
+    async def _detect(self, frames):
+        if self.roi is None and not self.tile_size:
+            # inference runs in detector thread, so event loop stays responsive:
+            return await self.detector.detect(frames, self.target_labels, self.input_size)
+
+        frames_regions = [self._get_regions(frame.shape[:2]) for frame in frames]
+
+        # crops and tiles of all frames go to detector in one batch:
+        batch_detections = iter(await self.detector.detect([frame[y_min:y_max, x_min:x_max]
+                                                            for frame, regions in zip(frames, frames_regions)
+                                                            for x_min, y_min, x_max, y_max in regions],
+                                                           self.target_labels, self.input_size))
+        detections = []
+
+        for frame, regions in zip(frames, frames_regions):
+            regions_data = [next(batch_detections).data[:, :6] + [x_min, y_min, x_min, y_min, 0, 0]
+                            for x_min, y_min, _, _ in regions]
+
+            data = np.concatenate(regions_data).astype(np.float32)
+            tiles = np.repeat(np.arange(len(regions)), [len(region_data) for region_data in regions_data])
+
+            # objects on tiles borders are found by several tiles:
+            if len(regions) > 1 and len(data):
+                data = _merge_boxes(data, tiles, regions, TILES_MERGE_THRESH)
+
+            detections.append(Boxes(data, frame.shape[:2]))
+
+        return detections
+
+    def _get_regions(self, frame_shape):
+        if frame_shape in self._regions:
+            return self._regions[frame_shape]
+
+        frame_height, frame_width = frame_shape
+        x_min, y_min, x_max, y_max = 0, 0, frame_width, frame_height
+
+        if self.roi is not None:
+            # region of interest is mapped to coordinates of detection frames:
+            roi = (self.roi / self.box_scale).astype(int)
+            roi = np.clip(roi, 0, [frame_width, frame_height, frame_width, frame_height])
+
+            if roi[2] > roi[0] and roi[3] > roi[1]:
+                x_min, y_min, x_max, y_max = roi
+
+        if self.tile_size:
+            x_starts = self._tile_starts(x_min, x_max)
+            y_starts = self._tile_starts(y_min, y_max)
+
+            regions = [(x_start, y_start, min(x_start + self.tile_size, x_max), min(y_start + self.tile_size, y_max))
+                       for y_start in y_starts for x_start in x_starts]
         else:
-            with torch.no_grad():
-                result = self.detector(source=frame, classes=self.target_labels, imgsz=self.input_size)[0]
-                detections = result.boxes.cpu()
+            regions = [(x_min, y_min, x_max, y_max)]
+
+        self.logger.info("Detect objects in {} region(s) of {}x{} frames.".format(len(regions), frame_width,
+                                                                                   frame_height))
+
+        self._regions[frame_shape] = regions
+
+        return regions
+
+    def _tile_starts(self, start, end):
+        step = max(int(self.tile_size * (1 - self.tile_overlap)), 1)
+        starts = list(range(start, max(end - self.tile_size, start) + 1, step))
+
+        # last tile is shifted to reach region end:
+        if starts[-1] + self.tile_size < end:
+            starts.append(end - self.tile_size)
 
-            # to release GIL:
-            await asyncio.sleep(DELAY_TIME)
+        return starts
 
-            result_tracks = self.tracker.update(detections.numpy())
+    def _adaptive_positions(self, indices):
+        frames_skip = self._adaptive_frames_skip()
+        positions = []
 
-            # to get around tracker mysterious bug:
-            if result_tracks.any():
-                self.last_tracks = result_tracks
+        # stride is counted from last detected frame, so it changes smoothly between batches:
+        for pos, index in enumerate(indices):
+            if index >= self.next_detect_index:
+                positions.append(pos)
+                self.next_detect_index = index + frames_skip + 1
+
+        return positions
+
+    def _adaptive_frames_skip(self):
+        active_tracks = self.tracker.tracked_stracks
+
+        if not active_tracks:
+            frames_skip = self.max_frames_skip
+        else:
+            boxes = np.array([track.xyxy for track in active_tracks]) * self.box_scale
+            points = np.stack([(boxes[:, 0] + boxes[:, 2]) / 2, boxes[:, 3]], axis=1)
+
+            # every frame is detected in crowded scenes and when objects may cross line soon:
+            if len(active_tracks) >= self.busy_tracks or self.zones.find_near_lines(points, self.line_margin).any():
+                frames_skip = 0
             else:
-                result_tracks = self.last_tracks
+                frames_skip = min(self.frames_skip, self.max_frames_skip)
+
+        # latency budget wins over activity, so processing never falls behind:
+        if self.realtime_factor and self.detect_time:
+            frames_skip = max(frames_skip, ceil(self.detect_time * self.fps * self.realtime_factor) - 1)
+
+        return frames_skip
+
+    def _extrapolate_tracks(self, index):
+        tracks = self.last_tracks.copy()
+
+        if self.last_detect_index is not None:
+            tracks[:, :4] += self.last_velocities * (index - self.last_detect_index)
+
+        return tracks
+
+    def _update_velocities(self, index, tracks):
+        self.last_velocities = np.zeros((len(tracks), 4))
+
+        if self.last_detect_index is None or not len(self.last_tracks):
+            return
+
+        # velocities of tracks found in previous detection too:
+        order = np.argsort(self.last_tracks[:, 4])
+        positions = np.clip(np.searchsorted(self.last_tracks[order, 4], tracks[:, 4]), 0, len(order) - 1)
+        found = self.last_tracks[order[positions], 4] == tracks[:, 4]
+
+        self.last_velocities[found] = (tracks[found, :4] - self.last_tracks[order[positions[found]], :4]) / \
+            (index - self.last_detect_index)
 
-        result_tracks = np.insert(result_tracks, 0, index + 1, 1)
-        result_tracks = result_tracks[:, :6].astype('int')
+    def _gate_positions(self, positions, frames):
+        # static frames are skipped only while tracker has no active tracks, tracker state carries forward:
+        moved = bool(self.tracker.tracked_stracks)
+        gated_positions = []
 
-        return result_tracks
+        for pos in positions:
+            # once something moved, rest of batch goes to detector, as new tracks may start there:
+            moved = self.motion_gate.check(frames[pos], force=moved) or moved
 
-    def _find_events(self, file_name, tracks):
-        line_k, line_b = None, None
+            if moved:
+                gated_positions.append(pos)
 
-        event_keys = ('timestamp', 'file_name', 'frame_index', 'track_id', 'event_name')
+        return gated_positions
 
-        event_data = []
+    def _find_events(self, frame_index, tracks):
+        track_ids = tracks[:, 5]
+        points = np.stack([(tracks[:, 1] + tracks[:, 3]) / 2, tracks[:, 4]], axis=1).astype(int)
 
-        if self.line_angle and self.line_point:
-            line_k, line_b = get_line_coefficients(self.line_angle, self.line_point)
+        slots, found = self.track_states.lookup(track_ids)
+        rows, found_positions = slots[found], np.flatnonzero(found)
 
-        for track in tracks:
-            index, x_min, y_min, x_max, y_max, track_id = track
-            x_pos, y_pos = int((x_min + x_max) / 2), int(y_max)
-            timestamp = datetime.now().strftime(DATETIME_FMT)
+        prev_points = np.stack([self.track_states['last_x'][rows], self.track_states['last_y'][rows]], axis=1)
+        prev_inside = self.track_states['inside'][rows]
 
-            if track_id not in self.total_tracks:
-                self.total_tracks.add(track_id)
+        # all tracks are checked against all zones at once:
+        crossed_tracks, crossed_zones = self.zones.find_crossings(prev_points, points[found])
+        inside = self.zones.find_inside(points)
 
-                event_name = NEW_OBJECT
-                event_values = (timestamp, file_name, int(index), int(track_id), event_name)
-                event_data.append(dict(zip(event_keys, event_values)))
+        entered_tracks, entered_polygons = np.nonzero(inside[found] & ~prev_inside)
+        exited_tracks, exited_polygons = np.nonzero(~inside[found] & prev_inside)
 
-            if self.line_angle and self.line_point and abs(line_k * x_pos + line_b - y_pos) < INTERSECT_THRESH:
-                event_name = LINE_INTERSECTION
-                event_values = (timestamp, file_name, int(index), int(track_id), event_name)
-                event_data.append(dict(zip(event_keys, event_values)))
+        new_positions = np.flatnonzero(~found)
 
-        return event_data
+        found_events = [(NEW_OBJECT, new_positions, np.full(len(new_positions), -1)),
+                        (LINE_INTERSECTION, found_positions[crossed_tracks], crossed_zones),
+                        (ZONE_ENTER, found_positions[entered_tracks], self.zones.polygon_ids[entered_polygons]),
+                        (ZONE_EXIT, found_positions[exited_tracks], self.zones.polygon_ids[exited_polygons])]
+
+        self._update_states(frame_index, track_ids, points, inside, rows, found)
+
+        positions = np.concatenate([event_positions for _, event_positions, _ in found_events])
+
+        # events of each track go in detection order, as tracks do:
+        order = np.argsort(positions, kind='stable')
+
+        events = np.empty(len(positions), dtype=EVENTS_DTYPE)
+        events['timestamp'] = np.datetime64(datetime.now(), 's')
+        events['frame_index'] = frame_index
+        events['track_id'] = track_ids[positions[order]]
+        events['event_id'] = np.concatenate([np.full(len(event_positions), EVENT_NAMES.index(event_name))
+                                             for event_name, event_positions, _ in found_events])[order]
+        events['zone_id'] = np.concatenate([zone_ids for _, _, zone_ids in found_events])[order]
+
+        return events
+
+    def _update_states(self, frame_index, track_ids, points, inside, rows, found):
+        self.track_states['last_frame'][rows] = frame_index
+        self.track_states['last_x'][rows] = points[found, 0]
+        self.track_states['last_y'][rows] = points[found, 1]
+        self.track_states['inside'][rows] = inside[found]
+
+        self.track_states.add(track_ids[~found], first_frame=frame_index, last_frame=frame_index,
+                              last_x=points[~found, 0], last_y=points[~found, 1], inside=inside[~found])
+
+        expired = self.track_states['last_frame'] < frame_index - self.track_ttl
+
+        # motion gate and latency budget stretch strides further, tracks still held by tracker are kept:
+        if expired.any():
+            held_ids = [track.track_id for track in self.tracker.tracked_stracks + self.tracker.lost_stracks]
+            expired &= ~np.isin(self.track_states.ids, held_ids)
+
+        self.track_states.evict(expired)
 
     def _filter_detections(self, detections):
         if not self.target_labels:
@@ -124,11 +501,3 @@ class FrameProcessor:
                 result.append(torch.stack(filtered_detections))
 
         return torch.cat(result)
-
-    @staticmethod
-    def _dump_tracks(tracks, tracks_dir):
-        tracks_df = pd.DataFrame(tracks, columns=TRACKS_DF_COLUMNS)
-        frame_index = tracks_df['frame_index'][0]
-
-        tracks_path = join(tracks_dir, '{}.csv'.format(frame_index))
-        tracks_df.to_csv(tracks_path, index=False)
@@ -1,11 +1,18 @@
 import numpy as np
 
-from sqlalchemy import create_engine, Column, INTEGER, VARCHAR, TIMESTAMP
-from sqlalchemy.orm import DeclarativeBase, Session
+from uuid import uuid4
+from time import monotonic
+from queue import Queue, Empty
+from threading import Thread, Event as Signal, Lock
+
+from sqlalchemy import create_engine, inspect, insert, delete, text, Column, INTEGER, VARCHAR, TIMESTAMP
+from sqlalchemy.orm import DeclarativeBase
 
 from psycopg2.extensions import register_adapter, AsIs
 
-from utils import create_logger
+from metrics import JobMetrics
+from constants import EVENT_NAMES, EVENTS_DTYPE
+from utils import create_logger, event_dicts
 
 
 class BaseModel(DeclarativeBase):
@@ -21,33 +28,157 @@ class Event(BaseModel):
     frame_index = Column(INTEGER, nullable=False)
     track_id = Column(INTEGER, nullable=False)
     event_name = Column(VARCHAR(length=128), nullable=False)
+    zone_name = Column(VARCHAR(length=128), nullable=True)
+    run_id = Column(VARCHAR(length=32), nullable=True)
 
 
 class EventSaver:
     logger = create_logger(__name__)
 
+    # engines with their connection pools are shared by all jobs:
+    _engines = {}
+    _engines_lock = Lock()
+
     def __init__(self, config):
-        database_url = ('{sql_dialect}+{db_driver}'
-                        '://{db_username}:{db_password}'
-                        '@{host_name}/{db_name}').format(**config)
+        if config.sql_dialect == 'sqlite':
+            database_url = 'sqlite:///{db_name}'.format(**config)
+        else:
+            database_url = ('{sql_dialect}+{db_driver}'
+                            '://{db_username}:{db_password}'
+                            '@{host_name}/{db_name}').format(**config)
+
+        self.engine = self._get_engine(database_url)
+
+        self.batch_size = config.batch_size
+        self.flush_interval = config.flush_interval
 
-        self.engine = create_engine(database_url)
-        BaseModel.metadata.create_all(bind=self.engine)
-        register_adapter(np.int64, lambda int64: AsIs(int64))
+        # rows of every job run are marked, so resumed job deletes only its own ones:
+        self.run_id = uuid4().hex
 
-    def save_events(self, events):
+        self._queue = Queue()
+        self._error = None
+
+        self.metrics = JobMetrics()
+
+        self._writer = Thread(target=self._write_events, name='saver', daemon=True)
+        self._writer.start()
+
+    def save_events(self, file_name, events, zone_names=()):
         frame_index = events[0]['frame_index']
 
         self.logger.newline()
-        self.logger.info("Saving event(s) for frame {} to database:".format(frame_index))
+        self.logger.info("Queue event(s) for frame {} to database:".format(frame_index))
 
         for event in events:
-            self._save_event(event)
-
-    def _save_event(self, event):
-        with Session(autoflush=False, bind=self.engine) as session:
-            event_entry = Event(**event)
-            session.add(event_entry)
-            session.commit()
+            event_name = EVENT_NAMES[event['event_id']]
+            self.logger.info("Track ID - {}, event name - {}.".format(event['track_id'], event_name))
+
+        self._queue.put((file_name, events, zone_names))
+
+    def delete_events(self, after_frame):
+        with self.engine.begin() as connection:
+            result = connection.execute(delete(Event).where(Event.run_id == self.run_id,
+                                                            Event.frame_index > after_frame))
+
+        if result.rowcount:
+            self.logger.info("Deleted {} event(s) of '{}' run after frame {} from database."
+                             .format(result.rowcount, self.run_id, after_frame))
+
+    def flush(self):
+        flushed = Signal()
+        self._queue.put(flushed)
+        flushed.wait()
+
+        # error is raised once, later batches are reported on their own:
+        error, self._error = self._error, None
+
+        if error:
+            raise error
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            # writer is stopped even when last rows failed:
+            self._queue.put(None)
+            self._writer.join()
+
+    def _write_events(self):
+        rows = []
+        deadline = None
+
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0.0, deadline - monotonic()) if rows else None)
+            except Empty:
+                item = (None, np.empty(0, dtype=EVENTS_DTYPE), ())
+
+            try:
+                if isinstance(item, tuple):
+                    file_name, events, zone_names = item
+
+                    if len(events) and not rows:
+                        deadline = monotonic() + self.flush_interval
+
+                    rows.extend(dict(row, run_id=self.run_id)
+                                for row in event_dicts(events, file_name, zone_names, datetime_fmt=None))
+
+                    # keep collecting until batch is full or flush interval is over:
+                    if rows and len(rows) < self.batch_size and monotonic() < deadline:
+                        continue
+
+                self._insert_rows(rows)
+            except Exception as error:
+                # writer thread never dies, so flush and close do not hang:
+                self._error = error
+                self.logger.error("Failed to write {} event(s): {}.".format(len(rows), error))
+
+            rows = []
+
+            # stop signal or flush request:
+            if item is None:
+                return
+            elif isinstance(item, Signal):
+                item.set()
+
+    def _insert_rows(self, rows):
+        if not rows:
+            return
+
+        try:
+            # one multi-row INSERT per batch:
+            with self.metrics.time('database'), self.engine.begin() as connection:
+                connection.execute(insert(Event), rows)
+        except Exception as error:
+            self._error = error
+            self.logger.error("Failed to save {} event(s) to database: {}.".format(len(rows), error))
+        else:
+            self.metrics.count('database_rows', len(rows))
+            self.logger.info("Saved {} event(s) to database.".format(len(rows)))
+
+    @classmethod
+    def _get_engine(cls, database_url):
+        with cls._engines_lock:
+            if database_url not in cls._engines:
+                engine = create_engine(database_url, pool_pre_ping=True)
+                BaseModel.metadata.create_all(bind=engine)
+
+                # tables created by older versions get their missing nullable columns:
+                existing_columns = {column['name'] for column in inspect(engine).get_columns(Event.__tablename__)}
+
+                with engine.begin() as connection:
+                    for column in Event.__table__.columns:
+                        if column.name in existing_columns or not column.nullable:
+                            continue
+
+                        connection.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                            Event.__tablename__, column.name, column.type.compile(dialect=engine.dialect))))
+
+                        cls.logger.info("Added '{}' column to '{}' table.".format(column.name, Event.__tablename__))
+
+                cls._engines[database_url] = engine
+
+            return cls._engines[database_url]
 
-            self.logger.info("Track ID - {}, event name - {}.".format(event['track_id'], event['event_name']))
+
+register_adapter(np.int64, lambda int64: AsIs(int64))
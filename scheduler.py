@@ -0,0 +1,173 @@
+import asyncio
+import numpy as np
+
+from time import monotonic
+from weakref import WeakSet
+from collections import OrderedDict, deque
+
+from utils import create_logger
+
+
+class InferenceRequest:
+    __slots__ = ('frames', 'classes', 'input_size', 'future', 'time')
+
+    def __init__(self, frames, classes, input_size, future):
+        self.frames = frames
+        self.classes = classes
+        self.input_size = input_size
+        self.future = future
+        self.time = monotonic()
+
+
+class StreamDetector:
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    async def detect(self, frames, classes, input_size):
+        return await self.scheduler.detect(self, frames, classes, input_size)
+
+    @property
+    def names(self):
+        return self.scheduler.detector.names
+
+
+class InferenceScheduler:
+    logger = create_logger(__name__)
+
+    def __init__(self, detector, max_batch, max_latency):
+        self.detector = detector
+
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+
+        self.batches_count = 0
+        self.frames_count = 0
+
+        # streams are dropped together with their processors:
+        self._streams = WeakSet()
+
+        # pending requests of each stream, streams are served in round-robin order:
+        self._queues = OrderedDict()
+        self._pending_frames = 0
+
+        self._arrived = None
+        self._task = None
+
+    def stream(self):
+        stream = StreamDetector(self)
+        self._streams.add(stream)
+
+        return stream
+
+    async def detect(self, stream, frames, classes, input_size):
+        future = asyncio.get_running_loop().create_future()
+
+        self._queues.setdefault(stream, deque()).append(InferenceRequest(frames, classes, input_size, future))
+        self._pending_frames += len(frames)
+
+        if self._task is None or self._task.done():
+            self._arrived = asyncio.Event()
+            self._task = asyncio.create_task(self._dispatch())
+        else:
+            self._arrived.set()
+
+        return await future
+
+    async def _dispatch(self):
+        while self._queues:
+            deadline = min(queue[0].time for queue in self._queues.values()) + self.max_latency
+
+            # batch waits for other streams until it is full or oldest request is too old:
+            while not self._ready() and monotonic() < deadline:
+                self._arrived.clear()
+
+                try:
+                    await asyncio.wait_for(self._arrived.wait(), deadline - monotonic())
+                except asyncio.TimeoutError:
+                    break
+
+            batch = self._next_batch()
+
+            if batch:
+                await self._run_batch(batch)
+
+    def _ready(self):
+        # nobody else can add frames when every stream is already waiting:
+        return self._pending_frames >= self.max_batch or len(self._queues) >= len(self._streams)
+
+    def _next_batch(self):
+        batch, frames_count = [], 0
+        input_size = None
+
+        # one request of every stream per round, so long videos do not starve short ones:
+        while frames_count < self.max_batch:
+            streams = [stream for stream, queue in self._queues.items()
+                       if input_size is None or queue[0].input_size == input_size]
+
+            if not streams:
+                break
+
+            for stream in streams:
+                request = self._queues[stream][0]
+
+                if batch and frames_count + len(request.frames) > self.max_batch:
+                    return batch
+
+                self._queues[stream].popleft()
+                self._pending_frames -= len(request.frames)
+
+                # served stream goes to the end of the line:
+                if self._queues[stream]:
+                    self._queues.move_to_end(stream)
+                else:
+                    del self._queues[stream]
+
+                # requests of cancelled jobs are dropped before inference:
+                if request.future.done():
+                    continue
+
+                batch.append(request)
+                frames_count += len(request.frames)
+                input_size = request.input_size
+
+                if frames_count >= self.max_batch:
+                    break
+
+        return batch
+
+    async def _run_batch(self, batch):
+        # streams with different target labels share one forward pass, their boxes are filtered afterwards:
+        if any(request.classes is None for request in batch):
+            classes = None
+        else:
+            classes = sorted(set().union(*(request.classes for request in batch)))
+
+        try:
+            detections = await self.detector.detect([frame for request in batch for frame in request.frames],
+                                                    classes, batch[0].input_size)
+        except Exception as error:
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(error)
+
+            return
+
+        self.batches_count += 1
+        self.frames_count += len(detections)
+
+        start = 0
+
+        for request in batch:
+            request_detections = detections[start:start + len(request.frames)]
+            start += len(request.frames)
+
+            if request.classes is not None and classes != sorted(request.classes):
+                request_detections = [boxes[np.isin(boxes.cls, list(request.classes))] for boxes in request_detections]
+
+            # cancelled jobs do not wait for their results:
+            if not request.future.done():
+                request.future.set_result(request_detections)
+
+    @property
+    def mean_batch(self):
+        return self.frames_count / self.batches_count if self.batches_count else 0.0
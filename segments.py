@@ -0,0 +1,150 @@
+import cv2
+import asyncio
+import numpy as np
+
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from omegaconf import DictConfig, OmegaConf
+
+from tracks import TrackStore
+from detector import registry
+from processor import FrameProcessor
+from utils import create_logger, box_iou
+
+
+def track_segment(config, input_path, start_index, end_index):
+    # runs in worker process of shared pool, detectors stay cached there between segments and jobs:
+    return asyncio.run(_track_segment(DictConfig(config), input_path, start_index, end_index))
+
+
+async def _track_segment(config, input_path, start_index, end_index):
+    detector = registry.get(config.detector_name, config.ckpt_root, config.backend, config.int8, config.threads)
+    processor = FrameProcessor(config, detector, TrackStore())
+
+    capture = cv2.VideoCapture(input_path)
+
+    # frames are skipped without conversion, as in decoder, seeking by frame number is not exact for every container:
+    for _ in range(start_index):
+        if not capture.grab():
+            break
+
+    segment_tracks = []
+    index = start_index
+
+    try:
+        while end_index is None or index < end_index:
+            frames = []
+
+            while len(frames) < processor.batch_size and (end_index is None or index + len(frames) < end_index):
+                success, frame = capture.read()
+
+                if not success:
+                    break
+
+                frames.append(frame)
+
+            if not frames:
+                break
+
+            # frames skip is applied to global frame indices, as in sequential run:
+            segment_tracks.extend(await processor.get_tracks(range(index, index + len(frames)), frames))
+            index += len(frames)
+    finally:
+        capture.release()
+
+    return segment_tracks
+
+
+class SegmentTracker:
+    logger = create_logger(__name__)
+
+    # worker pools are shared by all jobs, so detectors are loaded once per worker:
+    _executors = {}
+
+    def __init__(self, workers, overlap, iou_thresh):
+        self.workers = workers
+        self.overlap = overlap
+        self.iou_thresh = iou_thresh
+
+    async def track_frames(self, input_path, config):
+        capture = cv2.VideoCapture(input_path)
+        frames_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        capture.release()
+
+        starts = [frames_count * segment // self.workers for segment in range(self.workers)]
+
+        # last segment is read until end of file, as frame count may be inexact:
+        bounds = [(max(start - self.overlap, 0), start, end) for start, end in zip(starts, starts[1:] + [None])]
+
+        self.logger.info("Split '{}' video of {} frames into {} segments with {} frames overlap."
+                         .format(input_path, frames_count, len(bounds), self.overlap))
+
+        loop = asyncio.get_running_loop()
+        config = OmegaConf.to_container(config)
+
+        futures = [loop.run_in_executor(self._get_executor(), track_segment, config, input_path, warm_start, end)
+                   for warm_start, _, end in bounds]
+
+        try:
+            id_map, next_id = {}, 1
+            prev_tracks = []
+
+            for (warm_start, start, _), future in zip(bounds, futures):
+                segment_tracks = await future
+                warm_tracks, own_tracks = segment_tracks[:start - warm_start], segment_tracks[start - warm_start:]
+
+                # track IDs of each segment are local, tracks seen in overlap keep IDs of previous segment:
+                id_map = self._match_tracks(prev_tracks[-len(warm_tracks):] if warm_tracks else [], warm_tracks)
+
+                for tracks in own_tracks:
+                    for track_id in tracks[:, 5]:
+                        if track_id not in id_map:
+                            id_map[track_id], next_id = next_id, next_id + 1
+
+                    tracks[:, 5] = [id_map[track_id] for track_id in tracks[:, 5]]
+
+                    yield tracks
+
+                prev_tracks = own_tracks[-self.overlap:] if self.overlap else []
+        except BrokenProcessPool:
+            # crashed worker breaks whole pool, next job starts new one:
+            SegmentTracker._executors.pop(self.workers, None)
+            raise
+        finally:
+            # segments not started yet are dropped, running ones finish in background:
+            for future in futures:
+                future.cancel()
+
+    def _get_executor(self):
+        if self.workers not in self._executors:
+            # spawned workers do not inherit CUDA context and event loop of server:
+            self._executors[self.workers] = ProcessPoolExecutor(max_workers=self.workers,
+                                                                mp_context=get_context('spawn'))
+
+        return self._executors[self.workers]
+
+    def _match_tracks(self, prev_tracks, cur_tracks):
+        scores = {}
+
+        # IoU of every pair of tracks is summed over overlap frames:
+        for prev_frame_tracks, cur_frame_tracks in zip(prev_tracks, cur_tracks):
+            ious = box_iou(prev_frame_tracks[:, 1:5], cur_frame_tracks[:, 1:5])
+
+            for prev_pos, cur_pos in zip(*np.nonzero(ious)):
+                key = (prev_frame_tracks[prev_pos, 5], cur_frame_tracks[cur_pos, 5])
+                scores[key] = scores.get(key, 0.0) + ious[prev_pos, cur_pos]
+
+        id_map, used_ids = {}, set()
+
+        # greedy matching, best mean IoU over overlap goes first:
+        for (prev_id, cur_id), score in sorted(scores.items(), key=lambda item: item[1], reverse=True):
+            if score / len(cur_tracks) < self.iou_thresh:
+                break
+
+            if prev_id not in used_ids and cur_id not in id_map:
+                id_map[cur_id] = prev_id
+                used_ids.add(prev_id)
+
+        return id_map
@@ -0,0 +1,85 @@
+import numpy as np
+
+from dedup import EventDeduplicator
+from constants import EVENT_NAMES, EVENTS_DTYPE, NEW_OBJECT, LINE_INTERSECTION
+
+
+def make_events(*keys):
+    events = np.zeros(len(keys), dtype=EVENTS_DTYPE)
+
+    for event, (track_id, event_name, zone_id) in zip(events, keys):
+        event['track_id'], event['event_id'], event['zone_id'] = track_id, EVENT_NAMES.index(event_name), zone_id
+
+    return events
+
+
+def test_duplicates_are_rejected_within_interval():
+    deduplicator = EventDeduplicator(duplicate_frames=10)
+    events = make_events((1, LINE_INTERSECTION, 0))
+
+    assert deduplicator.admit(1, events).tolist() == [True]
+    assert deduplicator.admit(5, events).tolist() == [False]
+    assert deduplicator.admit(11, events).tolist() == [False]
+
+
+def test_events_are_readmitted_after_interval():
+    deduplicator = EventDeduplicator(duplicate_frames=10)
+    events = make_events((1, LINE_INTERSECTION, 0))
+
+    deduplicator.admit(1, events)
+
+    assert deduplicator.admit(12, events).tolist() == [True]
+    assert deduplicator.admit(20, events).tolist() == [False]
+
+
+def test_keys_differ_by_track_event_and_zone():
+    deduplicator = EventDeduplicator(duplicate_frames=10)
+
+    deduplicator.admit(1, make_events((1, LINE_INTERSECTION, 0)))
+    admitted = deduplicator.admit(2, make_events((1, LINE_INTERSECTION, 0), (2, LINE_INTERSECTION, 0),
+                                                 (1, NEW_OBJECT, -1), (1, LINE_INTERSECTION, 1)))
+
+    assert admitted.tolist() == [False, True, True, True]
+
+
+def test_duplicates_in_one_frame_are_admitted_once():
+    deduplicator = EventDeduplicator(duplicate_frames=10)
+    admitted = deduplicator.admit(1, make_events((1, LINE_INTERSECTION, 0), (1, LINE_INTERSECTION, 0)))
+
+    assert admitted.tolist() == [True, False]
+
+
+def test_keys_expire_across_frame_gaps():
+    deduplicator = EventDeduplicator(duplicate_frames=10)
+
+    for frame_index in range(1, 6):
+        deduplicator.admit(frame_index, make_events((frame_index, NEW_OBJECT, -1)))
+
+    assert len(deduplicator) == 5
+
+    # frames without events are never passed to deduplicator, jump over several wheel turns expires everything:
+    assert deduplicator.admit(100, make_events((1, NEW_OBJECT, -1))).tolist() == [True]
+    assert len(deduplicator) == 1
+
+
+def test_partial_expiry_keeps_recent_keys():
+    deduplicator = EventDeduplicator(duplicate_frames=10)
+
+    deduplicator.admit(1, make_events((1, NEW_OBJECT, -1)))
+    deduplicator.admit(8, make_events((2, NEW_OBJECT, -1)))
+
+    admitted = deduplicator.admit(15, make_events((1, NEW_OBJECT, -1), (2, NEW_OBJECT, -1)))
+
+    assert admitted.tolist() == [True, False]
+
+
+def test_empty_events():
+    deduplicator = EventDeduplicator(duplicate_frames=0)
+
+    assert deduplicator.admit(1, make_events()).tolist() == []
+
+    events = make_events((1, NEW_OBJECT, -1))
+
+    # without duplicate interval, same event fires again on next frame:
+    assert deduplicator.admit(1, events).tolist() == [True]
+    assert deduplicator.admit(2, events).tolist() == [True]
@@ -0,0 +1,158 @@
+import numpy as np
+import pytest
+
+from time import sleep
+from datetime import datetime
+from os.path import join
+
+from omegaconf import DictConfig
+from sqlalchemy import create_engine, select, func, text
+from sqlalchemy.exc import OperationalError, IntegrityError
+
+from saver import EventSaver, Event
+from constants import EVENT_NAMES, EVENTS_DTYPE, NEW_OBJECT
+
+
+def make_events(frame_index, count=1):
+    events = np.zeros(count, dtype=EVENTS_DTYPE)
+
+    events['timestamp'] = np.datetime64(datetime(2024, 1, 1))
+    events['frame_index'] = frame_index
+    events['track_id'] = np.arange(1, count + 1)
+    events['event_id'] = EVENT_NAMES.index(NEW_OBJECT)
+    events['zone_id'] = -1
+
+    return events
+
+
+def count_rows(saver, **filters):
+    with saver.engine.connect() as connection:
+        return connection.execute(select(func.count()).select_from(Event).filter_by(**filters)).scalar()
+
+
+@pytest.fixture
+def saver(tmp_path):
+    # every test gets own database file, so shared engines do not mix rows:
+    saver = EventSaver(DictConfig({'sql_dialect': 'sqlite', 'db_name': str(join(tmp_path, 'events.db')),
+                                   'batch_size': 4, 'flush_interval': 60.0}))
+    yield saver
+
+    if saver._writer.is_alive():
+        saver.close()
+
+
+def test_rows_wait_for_full_batch(saver):
+    saver.save_events('video.mp4', make_events(1, 3))
+    sleep(0.2)
+
+    # three rows do not fill batch of four, flush interval is long:
+    assert count_rows(saver) == 0
+
+    saver.save_events('video.mp4', make_events(2, 1))
+
+    for _ in range(50):
+        if count_rows(saver) == 4:
+            break
+
+        sleep(0.1)
+
+    assert count_rows(saver) == 4
+
+
+def test_flush_writes_partial_batch(saver):
+    saver.save_events('video.mp4', make_events(1, 2))
+    saver.flush()
+
+    assert count_rows(saver, file_name='video.mp4', frame_index=1) == 2
+
+
+def test_close_writes_rows_and_stops_writer(saver):
+    saver.save_events('video.mp4', make_events(5, 1))
+    saver.close()
+
+    assert count_rows(saver) == 1
+    assert not saver._writer.is_alive()
+
+
+def test_rows_are_marked_with_run_id(saver):
+    saver.save_events('video.mp4', make_events(1, 2))
+    saver.flush()
+
+    assert count_rows(saver, run_id=saver.run_id) == 2
+
+
+def test_delete_events_keeps_other_runs(saver, tmp_path):
+    other = EventSaver(DictConfig({'sql_dialect': 'sqlite', 'db_name': str(join(tmp_path, 'events.db')),
+                                   'batch_size': 4, 'flush_interval': 60.0}))
+
+    other.save_events('video.mp4', make_events(10, 1))
+    other.close()
+
+    saver.save_events('video.mp4', make_events(5, 1))
+    saver.save_events('video.mp4', make_events(10, 2))
+    saver.flush()
+
+    saver.delete_events(after_frame=5)
+
+    assert count_rows(saver, run_id=saver.run_id) == 1
+    assert count_rows(saver, run_id=other.run_id) == 1
+
+
+def test_database_error_is_raised_by_flush_once(saver):
+    saver.engine.dispose()
+    Event.__table__.drop(saver.engine)
+
+    saver.save_events('video.mp4', make_events(1, 1))
+
+    with pytest.raises(OperationalError):
+        saver.flush()
+
+    # writer survives error, so later flush does not hang:
+    assert saver._writer.is_alive()
+
+    # error is not raised again after database recovers:
+    Event.__table__.create(saver.engine)
+
+    saver.save_events('video.mp4', make_events(2, 1))
+    saver.close()
+
+    assert count_rows(saver, frame_index=2) == 1
+    assert not saver._writer.is_alive()
+
+
+def test_rejected_rows_do_not_kill_writer(saver):
+    # file name column is not nullable:
+    saver.save_events(None, make_events(1, 1))
+
+    with pytest.raises(IntegrityError):
+        saver.flush()
+
+    assert saver._writer.is_alive()
+
+    saver.save_events('video.mp4', make_events(2, 1))
+    saver.close()
+
+    assert count_rows(saver) == 1
+    assert not saver._writer.is_alive()
+
+
+def test_old_table_gets_missing_columns(tmp_path):
+    db_path = str(join(tmp_path, 'old.db'))
+    engine = create_engine('sqlite:///' + db_path)
+
+    # table of version without zone names and run IDs:
+    with engine.begin() as connection:
+        connection.execute(text('CREATE TABLE events (event_id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                'timestamp TIMESTAMP NOT NULL, file_name VARCHAR(128) NOT NULL, '
+                                'frame_index INTEGER NOT NULL, track_id INTEGER NOT NULL, '
+                                'event_name VARCHAR(128) NOT NULL)'))
+
+    engine.dispose()
+
+    saver = EventSaver(DictConfig({'sql_dialect': 'sqlite', 'db_name': db_path,
+                                   'batch_size': 4, 'flush_interval': 60.0}))
+
+    saver.save_events('video.mp4', make_events(1, 2))
+    saver.close()
+
+    assert count_rows(saver, run_id=saver.run_id) == 2
@@ -0,0 +1,114 @@
+import numpy as np
+
+from os.path import join, getsize
+
+from tracks import TrackStore
+
+
+def make_tracks(frame_index, count):
+    # columns are frame index, box and track ID, boxes are derived from frame index to be checked later:
+    return np.array([[frame_index, frame_index, track_id, frame_index + 10, track_id + 10, track_id]
+                     for track_id in range(1, count + 1)], dtype=TrackStore.dtype).reshape(-1, 6)
+
+
+def fill(store, start_index, end_index):
+    # number of tracks varies, every third frame has none:
+    for frame_index in range(start_index, end_index):
+        store.append(frame_index, make_tracks(frame_index, frame_index % 3))
+
+
+def check_frames(store, start_index, end_index):
+    for frame_index in range(start_index, end_index):
+        assert np.array_equal(store.frames(frame_index, frame_index + 1), make_tracks(frame_index, frame_index % 3))
+
+
+def test_frames_and_track():
+    store = TrackStore(capacity=2)
+    fill(store, 1, 50)
+
+    check_frames(store, 1, 50)
+    assert len(store.frames(1, 50)) == sum(frame_index % 3 for frame_index in range(1, 50))
+
+    track = store.track(2, 10, 20)
+    assert np.array_equal(track[:, 0], [frame_index for frame_index in range(10, 20) if frame_index % 3 == 2])
+
+
+def test_skipped_frames_are_empty():
+    store = TrackStore()
+
+    store.append(1, make_tracks(1, 2))
+    store.append(5, make_tracks(5, 1))
+
+    assert len(store.frames(2, 5)) == 0
+    assert np.array_equal(store.frames(1, 6), np.concatenate([make_tracks(1, 2), make_tracks(5, 1)]))
+
+
+def test_drop_frames_keeps_window(tmp_path):
+    dump_path = str(join(tmp_path, 'video.tracks'))
+    store = TrackStore(dump_path, capacity=4, max_frames=10)
+
+    fill(store, 1, 100)
+
+    # frames are dropped in steps, at least max_frames last frames are always kept:
+    assert 100 - 10 - 10 <= store.first_frame <= 100 - 10
+    assert store.last_frame == 99
+    check_frames(store, store.first_frame, 100)
+
+    # dropped frames are clamped to first kept one:
+    assert np.array_equal(store.frames(1, store.first_frame + 1), store.frames(store.first_frame,
+                                                                               store.first_frame + 1))
+
+    # track rows are trimmed together with window:
+    track = store.track(2)
+    assert np.array_equal(track[:, 0], [frame_index for frame_index in range(store.first_frame, 100)
+                                        if frame_index % 3 == 2])
+    assert len(store.track(2, 1, store.first_frame)) == 0
+    assert len(store.track(3)) == 0
+
+    store.flush()
+    dumped = TrackStore.load(dump_path)
+
+    assert np.array_equal(dumped, np.concatenate([make_tracks(frame_index, frame_index % 3)
+                                                  for frame_index in range(1, 100)]))
+
+
+def test_flush_appends_to_dump(tmp_path):
+    dump_path = str(join(tmp_path, 'video.tracks'))
+    store = TrackStore(dump_path, flush_size=5)
+
+    fill(store, 1, 30)
+    store.flush()
+
+    assert getsize(dump_path) == store.dump_size
+    assert np.array_equal(TrackStore.load(dump_path), store.frames(1, 30))
+
+
+def test_restore_truncates_dump_and_offsets(tmp_path):
+    dump_path = str(join(tmp_path, 'video.tracks'))
+
+    reference = TrackStore(join(tmp_path, 'reference.tracks'))
+    fill(reference, 1, 60)
+    reference.flush()
+
+    interrupted = TrackStore(dump_path)
+    fill(interrupted, 1, 40)
+    interrupted.flush()
+
+    checkpoint_size = interrupted.dump_size
+
+    # rows written after checkpoint at frame 40 are lost with interrupted job:
+    fill(interrupted, 40, 50)
+    interrupted.flush()
+
+    resumed = TrackStore(dump_path, flush_size=4)
+    resumed.restore(interrupted.frames(30, 40), 30, 40, checkpoint_size)
+
+    assert resumed.first_frame == 30
+    assert resumed.last_frame == 39
+    check_frames(resumed, 30, 40)
+
+    fill(resumed, 40, 60)
+    resumed.flush()
+
+    check_frames(resumed, 30, 60)
+    assert np.array_equal(TrackStore.load(dump_path), TrackStore.load(join(tmp_path, 'reference.tracks')))
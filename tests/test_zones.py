@@ -0,0 +1,77 @@
+import numpy as np
+
+from zones import Zones
+from constants import LINE_ZONE, POLYGON_ZONE
+
+
+def make_zones(cell_size=64):
+    return Zones([('vertical', LINE_ZONE, [[100, 0], [100, 200]]),
+                  ('square', POLYGON_ZONE, [[0, 0], [50, 0], [50, 50], [0, 50]]),
+                  ('horizontal', LINE_ZONE, [[0, 300], [400, 300]]),
+                  ('triangle', POLYGON_ZONE, [[200, 200], [300, 200], [250, 100]])], cell_size)
+
+
+def test_find_crossings():
+    zones = make_zones()
+
+    prev_points = np.array([[90, 50], [110, 50], [90, 250], [200, 290], [90, 50], [80, 100]], dtype=float)
+    cur_points = np.array([[110, 50], [90, 50], [110, 250], [200, 310], [95, 60], [95, 100]], dtype=float)
+
+    tracks, zone_ids = zones.find_crossings(prev_points, cur_points)
+
+    # both directions cross, passes beside line segment or short of it do not:
+    assert sorted(zip(tracks.tolist(), zone_ids.tolist())) == [(0, 0), (1, 0), (3, 2)]
+
+
+def test_point_on_line_is_counted_once():
+    zones = make_zones()
+
+    points = np.array([[90, 50], [100, 50], [110, 50]], dtype=float)
+    first_tracks, _ = zones.find_crossings(points[:1], points[1:2])
+    second_tracks, _ = zones.find_crossings(points[1:2], points[2:])
+
+    assert len(first_tracks) + len(second_tracks) == 1
+
+
+def test_crossing_of_several_lines():
+    zones = Zones([('first', LINE_ZONE, [[100, 0], [100, 200]]), ('second', LINE_ZONE, [[150, 0], [150, 200]])], 32)
+
+    tracks, zone_ids = zones.find_crossings(np.array([[50.0, 100.0]]), np.array([[200.0, 100.0]]))
+
+    assert tracks.tolist() == [0, 0]
+    assert sorted(zone_ids.tolist()) == [0, 1]
+
+
+def test_find_inside():
+    zones = make_zones()
+
+    points = np.array([[25, 25], [60, 25], [250, 150], [250, 90], [210, 190], [500, 500]], dtype=float)
+    inside = zones.find_inside(points)
+
+    # columns follow polygon zones order:
+    assert inside.shape == (6, 2)
+    assert inside.tolist() == [[True, False], [False, False], [False, True], [False, False], [False, True],
+                               [False, False]]
+
+
+def test_grid_cell_size_does_not_change_results():
+    points = np.random.default_rng(0).uniform(-50, 450, size=(200, 2))
+    moves = np.random.default_rng(1).uniform(-60, 60, size=(200, 2))
+
+    results = []
+
+    for cell_size in (8, 64, 1000):
+        zones = make_zones(cell_size)
+        tracks, zone_ids = zones.find_crossings(points, points + moves)
+
+        results.append((sorted(zip(tracks.tolist(), zone_ids.tolist())), zones.find_inside(points).tolist()))
+
+    assert results[0] == results[1] == results[2]
+
+
+def test_empty_inputs():
+    zones = make_zones()
+    tracks, zone_ids = zones.find_crossings(np.empty((0, 2)), np.empty((0, 2)))
+
+    assert len(tracks) == len(zone_ids) == 0
+    assert zones.find_inside(np.empty((0, 2))).shape == (0, 2)
@@ -0,0 +1,227 @@
+import numpy as np
+
+from os import makedirs
+from os.path import dirname
+from bisect import bisect_left
+from collections import defaultdict
+
+from constants import TRACKS_COLUMNS
+
+
+class TrackStore:
+    dtype = np.int32
+
+    def __init__(self, dump_path=None, flush_size=0, capacity=4096, max_frames=0):
+        self.dump_path = dump_path
+        self.flush_size = flush_size
+
+        # only last max_frames frames are kept in memory, 0 keeps all of them:
+        self.max_frames = max_frames
+
+        self._rows = np.empty((capacity, len(TRACKS_COLUMNS)), dtype=self.dtype)
+        self._size = 0
+        self._flushed = 0
+
+        # rows of frame i are stored in [_frame_offsets[i - _first_frame + 1], _frame_offsets[i - _first_frame + 2]):
+        self._frame_offsets = np.zeros(capacity + 1, dtype=np.int64)
+        self._first_frame = 1
+        self._last_frame = 0
+
+        # rows of every track by their position counted from first appended row, so dropping keeps them valid:
+        self._track_rows = defaultdict(list)
+        self._dropped = 0
+
+        # dump file is truncated on first flush, resumed job keeps its checkpointed part:
+        self._dump_size = None
+
+        if self.dump_path:
+            makedirs(dirname(self.dump_path) or '.', exist_ok=True)
+
+    def append(self, frame_index, tracks):
+        if frame_index <= self._last_frame:
+            raise ValueError("Frames must be appended in increasing order, got {} after {}."
+                             .format(frame_index, self._last_frame))
+
+        if self.max_frames and frame_index - self._first_frame >= 2 * self.max_frames:
+            self._drop_frames(frame_index - self.max_frames)
+
+        self._reserve(self._size + len(tracks), frame_index - self._first_frame + 3)
+
+        start, end = self._size, self._size + len(tracks)
+        last_pos, pos = self._last_frame - self._first_frame + 1, frame_index - self._first_frame + 1
+
+        # frames without tracks get empty ranges:
+        self._frame_offsets[last_pos + 1:pos + 1] = start
+        self._frame_offsets[pos + 1] = end
+
+        self._rows[start:end] = tracks
+        self._size = end
+        self._last_frame = frame_index
+
+        for row, track_id in enumerate(self._rows[start:end, -1].tolist(), self._dropped + start):
+            self._track_rows[track_id].append(row)
+
+        if self.flush_size and self._size - self._flushed >= self.flush_size:
+            self.flush()
+
+    def frames(self, start_index, end_index):
+        start, end = self._frame_rows(start_index, end_index)
+        return self._rows[start:end]
+
+    def track(self, track_id, start_index=None, end_index=None):
+        track_rows = self._track_rows.get(track_id)
+
+        if not track_rows:
+            return self._rows[:0]
+
+        # rows of frame range are found by bisecting positions of track rows:
+        start, end = self._frame_rows(start_index or self._first_frame, end_index or self._last_frame + 1)
+        start, end = bisect_left(track_rows, self._dropped + start), bisect_left(track_rows, self._dropped + end)
+
+        return self._rows[np.array(track_rows[start:end], dtype=np.int64) - self._dropped]
+
+    def flush(self):
+        if not self.dump_path or self._dump_size is not None and self._flushed == self._size:
+            return
+
+        with open(self.dump_path, 'ab' if self._dump_size is not None else 'wb') as dump_file:
+            self._rows[self._flushed:self._size].tofile(dump_file)
+            self._dump_size = dump_file.tell()
+
+        self._flushed = self._size
+
+    def restore(self, tracks, start_index, end_index, dump_size=0):
+        if self.dump_path:
+            with open(self.dump_path, 'ab') as dump_file:
+                dump_file.truncate(dump_size)
+
+            self._dump_size = dump_size
+
+        # resumed store starts at first restored frame:
+        if not self._last_frame:
+            self._first_frame, self._last_frame = start_index, start_index - 1
+
+        frame_offsets = np.searchsorted(tracks[:, 0], np.arange(start_index, end_index + 1))
+        flush_size, self.flush_size = self.flush_size, 0
+
+        # tracks of checkpointed frames are already in dump file, so they are never flushed again:
+        for frame_index, start, end in zip(range(start_index, end_index), frame_offsets[:-1], frame_offsets[1:]):
+            self.append(frame_index, tracks[start:end])
+            self._flushed = self._size
+
+        self.flush_size = flush_size
+
+    @property
+    def dump_size(self):
+        return self._dump_size or 0
+
+    @classmethod
+    def load(cls, dump_path):
+        return np.fromfile(dump_path, dtype=cls.dtype).reshape(-1, len(TRACKS_COLUMNS))
+
+    def _drop_frames(self, first_frame):
+        # dropped rows are dumped first, memory stays bounded for endless streams:
+        self.flush()
+
+        drop_pos = first_frame - self._first_frame
+        dropped = self._frame_offsets[drop_pos + 1]
+        frames_count = self._last_frame - first_frame + 1
+
+        self._rows[:self._size - dropped] = self._rows[dropped:self._size]
+        offsets = self._frame_offsets[drop_pos + 1:drop_pos + frames_count + 2] - dropped
+        self._frame_offsets[1:frames_count + 2] = offsets
+
+        self._size -= dropped
+        self._flushed = max(self._flushed - dropped, 0)
+        self._first_frame = first_frame
+        self._dropped += int(dropped)
+
+        # track rows are trimmed together with window:
+        for track_id in list(self._track_rows):
+            track_rows = self._track_rows[track_id]
+            del track_rows[:bisect_left(track_rows, self._dropped)]
+
+            if not track_rows:
+                del self._track_rows[track_id]
+
+    def _frame_rows(self, start_index, end_index):
+        start_index = max(self._first_frame, min(start_index, self._last_frame + 1))
+        end_index = max(start_index, min(end_index, self._last_frame + 1))
+
+        return (int(self._frame_offsets[start_index - self._first_frame + 1]),
+                int(self._frame_offsets[end_index - self._first_frame + 1]))
+
+    def _reserve(self, rows_count, frames_count):
+        if rows_count > len(self._rows):
+            rows = np.empty((max(rows_count, 2 * len(self._rows)), len(TRACKS_COLUMNS)), dtype=self.dtype)
+            rows[:self._size] = self._rows[:self._size]
+            self._rows = rows
+
+        if frames_count > len(self._frame_offsets):
+            frames_kept = self._last_frame - self._first_frame + 2
+
+            frame_offsets = np.zeros(max(frames_count, 2 * len(self._frame_offsets)), dtype=np.int64)
+            frame_offsets[:frames_kept + 1] = self._frame_offsets[:frames_kept + 1]
+            self._frame_offsets = frame_offsets
+
+    @property
+    def first_frame(self):
+        return self._first_frame
+
+    @property
+    def last_frame(self):
+        return self._last_frame
+
+    def __len__(self):
+        return self._size
+
+
+class TrackState:
+    def __init__(self, **columns):
+        # columns are given as name=(dtype, fill_value[, row_shape]), rows are kept sorted by track ID:
+        self._fills = {name: spec[1] for name, spec in columns.items()}
+        self._columns = {name: np.empty((0, *spec[2:][0]) if spec[2:] else 0, dtype=spec[0])
+                         for name, spec in columns.items()}
+
+        self.ids = np.empty(0, dtype=np.int64)
+
+    def lookup(self, track_ids):
+        slots = np.searchsorted(self.ids, track_ids)
+        found = slots < len(self.ids)
+        found[found] = self.ids[slots[found]] == track_ids[found]
+
+        return slots, found
+
+    def add(self, track_ids, **values):
+        if not len(track_ids):
+            return
+
+        order = np.argsort(track_ids)
+
+        # BYTETracker IDs grow monotonically, so new rows are almost always appended to the end:
+        positions = np.searchsorted(self.ids, track_ids[order])
+        self.ids = np.insert(self.ids, positions, track_ids[order])
+
+        for name, column in self._columns.items():
+            value = values.get(name, self._fills[name])
+            value = value[order] if np.ndim(value) else value
+
+            self._columns[name] = np.insert(column, positions, value, axis=0)
+
+    def evict(self, mask):
+        if not mask.any():
+            return
+
+        self.ids = self.ids[~mask]
+
+        for name, column in self._columns.items():
+            self._columns[name] = column[~mask]
+
+    def __getitem__(self, name):
+        return self._columns[name]
+
+    def __setitem__(self, name, column):
+        self._columns[name] = column
+
+    def __len__(self):
+        return len(self.ids)
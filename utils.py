@@ -1,19 +1,34 @@
+import numpy as np
+
 from itertools import count
 from os import listdir, path
-from math import tan, radians
 from datetime import datetime
 from logging import getLogger, INFO, StreamHandler, FileHandler, Formatter
 
-from constants import DATETIME_FMT
+from constants import DATETIME_FMT, EVENT_NAMES
 
 
-async def async_enumerate(async_iterable):
-    index = count()
+async def async_enumerate(async_iterable, start=0):
+    index = count(start)
 
     async for item in async_iterable:
         yield next(index), item
 
 
+async def async_batched(async_iterable, batch_size):
+    batch = []
+
+    async for item in async_iterable:
+        batch.append(item)
+
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
 def sorted_listdir(target_dir):
     for file_name in sorted(listdir(target_dir), key=lambda name: int(path.splitext(name)[0])):
         yield file_name
@@ -57,6 +72,29 @@ def create_logger(name, stream=True, file=True, level=INFO):
     return logger
 
 
-def get_line_coefficients(degree=0, point=(0, 0)):
-    # k = tan(alpha), b = y - k * x:
-    return tan(radians(degree)), point[1] - tan(radians(degree)) * point[0]
+def event_dicts(events, file_name, zone_names=(), datetime_fmt=DATETIME_FMT):
+    timestamps = [timestamp.item() for timestamp in events['timestamp']]
+
+    # timestamps are left as datetime objects if no format is given:
+    if datetime_fmt:
+        timestamps = [timestamp.strftime(datetime_fmt) for timestamp in timestamps]
+
+    return [{'timestamp': timestamp,
+             'file_name': file_name,
+             'frame_index': int(event['frame_index']),
+             'track_id': int(event['track_id']),
+             'event_name': EVENT_NAMES[event['event_id']],
+             'zone_name': zone_names[event['zone_id']] if event['zone_id'] >= 0 else None}
+            for timestamp, event in zip(timestamps, events)]
+
+
+def box_iou(boxes1, boxes2):
+    top_left = np.maximum(boxes1[:, None, :2], boxes2[None, :, :2])
+    bottom_right = np.minimum(boxes1[:, None, 2:], boxes2[None, :, 2:])
+
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    areas1 = np.prod(boxes1[:, 2:] - boxes1[:, :2], axis=1)
+    areas2 = np.prod(boxes2[:, 2:] - boxes2[:, :2], axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.nan_to_num(intersection / (areas1[:, None] + areas2[None, :] - intersection))
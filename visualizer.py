@@ -1,24 +1,31 @@
 import cv2
+import numpy as np
 
-from random import randint
-
-from utils import get_line_coefficients
+from constants import LINE_ZONE
 
 
 # TODO: Config for visualizer (bbs and line params).
 class EventVisualizer:
-    def __init__(self, line_angle, line_point):
-        self.line_angle = line_angle
-        self.line_point = line_point
-        self._track_colors = {}
+    def __init__(self, zones):
+        self.zones = zones
+
+        # output frames may be smaller than source ones, tracks and zones are scaled down with it:
+        self.frame_scale = np.ones(4)
+
+        # zones overlay and its mask for each frame size:
+        self._overlays = {}
 
     def draw_annotations(self, index, frame, tracks):
-        if self.line_angle and self.line_point:
-            frame = self._draw_line(frame, *get_line_coefficients(self.line_angle, self.line_point))
+        if len(self.zones):
+            frame = self._draw_zones(frame)
 
         frame = self._draw_text(frame, "frame {}".format(index))
 
-        for track in tracks.to_numpy():
+        if len(tracks):
+            tracks = tracks.copy()
+            tracks[:, 1:5] = tracks[:, 1:5] * self.frame_scale
+
+        for track in tracks:
             frame = self._draw_bounding_box(frame, track[1:])
 
         return frame
@@ -27,12 +34,9 @@ class EventVisualizer:
         x_min, y_min, x_max, y_max, track_id = track
         x_anchor, y_anchor = int((x_min + x_max) / 2), int(y_max)
 
-        if track_id not in self._track_colors:
-            self._track_colors[track_id] = self._random_color()
-
         font = cv2.FONT_HERSHEY_DUPLEX
         scale = 1
-        color = self._track_colors[track_id]
+        color = self._track_color(track_id)
         thickness = 2
         radius = -1
 
@@ -44,26 +48,38 @@ class EventVisualizer:
 
         return frame
 
-    @staticmethod
-    def _draw_line(frame, line_k, line_b):
-        frame_height, frame_width, _ = frame.shape
+    def _draw_zones(self, frame):
+        frame_shape = frame.shape
 
-        x1 = -line_b / line_k
-        y1 = line_b
+        if frame_shape not in self._overlays:
+            self._overlays[frame_shape] = self._zones_overlay(frame_shape)
 
-        point1 = (int(x1), 0) if x1 > 0 else (0, int(y1))
+        overlay, mask = self._overlays[frame_shape]
+        frame[mask] = overlay[mask]
 
-        x2 = (frame_height - line_b) / line_k
-        y2 = line_k * frame_width + line_b
+        return frame
 
-        point2 = (int(x2), frame_height) if x2 > 0 else (frame_width, int(y2))
+    def _zones_overlay(self, frame_shape):
+        overlay = np.zeros(frame_shape, dtype=np.uint8)
 
+        font = cv2.FONT_HERSHEY_DUPLEX
+        scale = 1
         color = (255, 255, 255)
         thickness = 4
 
-        frame = cv2.line(frame, point1, point2, color, thickness)
+        for name, kind, points in zip(self.zones.names, self.zones.kinds, self.zones.points):
+            points = (points * self.frame_scale[:2]).astype(int)
 
-        return frame
+            if kind == LINE_ZONE:
+                overlay = cv2.line(overlay, tuple(points[0]), tuple(points[1]), color, thickness)
+                position = tuple(points[:2].mean(axis=0).astype(int))
+            else:
+                overlay = cv2.polylines(overlay, [points], True, color, thickness)
+                position = tuple(points[0])
+
+            overlay = cv2.putText(overlay, name, position, font, scale, color)
+
+        return overlay, overlay.any(axis=2)
 
     @staticmethod
     def _draw_text(frame, text):
@@ -77,5 +93,7 @@ class EventVisualizer:
         return frame
 
     @staticmethod
-    def _random_color():
-        return randint(0, 255), randint(0, 255), randint(0, 255)
+    def _track_color(track_id):
+        # color is derived from track ID, so nothing is kept per track:
+        color_hash = int(track_id) * 2654435761 % 2 ** 32
+        return color_hash & 255, color_hash >> 8 & 255, color_hash >> 16 & 255
@@ -1,79 +1,418 @@
 import cv2
+import asyncio
+import numpy as np
 
-from os import mkdir
-from os.path import exists, join, splitext
+from os import mkdir, makedirs, listdir
+from cProfile import Profile
+from itertools import islice
+from os.path import exists, join, splitext, getsize
 
 from ffmpeg.asyncio import FFmpeg
+from omegaconf import OmegaConf
 
-from utils import async_enumerate, sorted_listdir, create_logger
+from cache import DetectionCache, DetectionSpill
+from checkpoint import JobCheckpointer
+from decoder import FrameDecoder
+from dedup import EventDeduplicator
+from segments import SegmentTracker
+from metrics import JobMetrics, registry as metrics_registry
+from constants import EVENT_NAMES, EVENTS_DTYPE, DETECTIONS_PARAMS, ZONES_PARAMS, TRACKS_PARAMS
+from utils import async_enumerate, async_batched, sorted_listdir, create_logger
 
 
 class EventWatcher:
     logger = create_logger(__name__)
 
+    # cProfile can not profile several jobs in one thread:
+    _profiling = False
+
     def __init__(self, config, processor, extractor, saver):
-        self.target_events = config.target_events
+        self.target_events = np.array([EVENT_NAMES.index(event_name) for event_name in config.target_events])
 
         self.duplicate_frames = int(config.duplicate_interval * config.fps)
+        self.deduplicator = EventDeduplicator(self.duplicate_frames)
 
         self.inputs_root = config.inputs_root
         self.frames_root = config.frames_root
 
+        self.streaming = config.streaming
+        self.decoder = FrameDecoder(config.decode_buffer)
+
+        # detection frames are decoded near detector input size, output ones are optionally kept in full size:
+        self.detect_resolution = config.detect_resolution
+        self.full_resolution = config.full_resolution
+
+        # with several workers, detection and tracking run on video segments in parallel processes:
+        self.segment_tracker = SegmentTracker(config.segment_workers, config.segment_overlap, config.segment_iou) \
+            if config.segment_workers > 1 else None
+
+        # detections and tracks of already processed videos are replayed from disk:
+        self.cache = DetectionCache(config.cache_root, config.cache_size * 2 ** 20) if config.cache_root else None
+        self.cache_tracks = config.cache_tracks
+
+        self._cached_tracks = None
+
+        # long videos are resumed from last checkpoint, tracks of segments are not checkpointed:
+        self.checkpointer = JobCheckpointer(config.checkpoint_root, config.checkpoint_interval) \
+            if config.checkpoint_root and self.segment_tracker is None else None
+
+        # stage timings and counters of all components are collected per job:
+        self.metrics = JobMetrics(config.metrics)
+        self.profile_root = config.profile_root
+
         self.processor = processor
         self.extractor = extractor
         self.saver = saver
 
-        self.unique_events = dict()
+        self.processor.metrics = self.extractor.metrics = self.saver.metrics = self.metrics
 
-    async def watch_events(self, file_name):
-        input_path = str(join(self.inputs_root, file_name))
+    async def watch_events(self, file_name, listener=None):
+        self.metrics.job_name = self.metrics.job_name or file_name
+        metrics_registry.add(self.metrics)
+
+        try:
+            if self.profile_root and not EventWatcher._profiling:
+                return await self._profile_events(file_name, listener)
+
+            return await self._watch_events(file_name, listener)
+        finally:
+            if self.metrics.enabled:
+                self.metrics.log_summary()
+
+    async def _profile_events(self, file_name, listener):
+        profiler = Profile()
 
-        base_name = splitext(file_name)[0]
+        # profiler sees every coroutine run by event loop meanwhile, so only one job is profiled at once:
+        EventWatcher._profiling = True
+        profiler.enable()
 
-        frames_dir = str(join(self.frames_root, base_name))
+        try:
+            return await self._watch_events(file_name, listener)
+        finally:
+            profiler.disable()
+            EventWatcher._profiling = False
 
-        if not exists(frames_dir):
-            mkdir(frames_dir)
+            makedirs(self.profile_root, exist_ok=True)
 
-        await self._split_frames(input_path, frames_dir)
+            profile_path = str(join(self.profile_root, splitext(file_name)[0] + '.prof'))
+            profiler.dump_stats(profile_path)
+
+            self.logger.info("Write profile of '{}' job to '{}' file.".format(self.metrics.job_name, profile_path))
+
+    async def _watch_events(self, file_name, listener):
+        input_path = str(join(self.inputs_root, file_name))
 
         total_events = []
+        checkpoint_index = 0
+
+        # setup already opens input, so saver and extractor are released even when it fails:
+        try:
+            checkpoint_key = checkpoint = None
+
+            if self.checkpointer:
+                checkpoint_key = self._checkpoint_key(input_path)
+                checkpoint = await asyncio.get_running_loop().run_in_executor(None, self.checkpointer.load,
+                                                                              file_name, checkpoint_key)
+
+            # frames of unfinished clips are decoded again before checkpointed frame:
+            start_index = checkpoint['replay_index'] - 1 if checkpoint else 0
+
+            if self.streaming and self.detect_resolution and self.segment_tracker is None:
+                frames = self._decode_scaled(input_path, start_index)
+            elif self.streaming:
+                frames = self.decoder.decode_frames(input_path, start_index=start_index)
+            else:
+                frames_dir = str(join(self.frames_root, splitext(file_name)[0]))
+
+                if not exists(frames_dir):
+                    mkdir(frames_dir)
+
+                # frames are split completely before first checkpoint:
+                if not checkpoint or not listdir(frames_dir):
+                    with self.metrics.time('split'):
+                        await self._split_frames(input_path, frames_dir)
+
+                frames = self._get_frames(frames_dir, start_index)
+
+            frames = self.metrics.timed('decode', frames, 'decoded_frames')
+
+            cache_keys = await self._load_cache(input_path) if self.cache else None
+
+            if checkpoint:
+                total_events = await self._resume(file_name, checkpoint, frames)
+                checkpoint_index = checkpoint['frame_index']
+
+            async for indices, batch_frames, batch_events in self._process_frames(input_path, frames,
+                                                                                  checkpoint_index):
+                found_events = []
+
+                for index, frame, events in zip(indices, batch_frames, batch_events):
+                    self.extractor.frame_buffer.append(index + 1, frame)
+
+                    with self.metrics.time('filter'):
+                        filtered_events = self._filter_events(index + 1, events)
+
+                    if len(filtered_events):
+                        self.extractor.events_queue.append(filtered_events)
+                        self.saver.save_events(file_name, filtered_events, self.processor.zones.names)
+
+                        found_events.append(filtered_events)
+                        self.metrics.count('events', len(filtered_events))
+
+                    with self.metrics.time('extract'):
+                        self.extractor.extract_events(file_name)
+
+                total_events.extend(found_events)
+
+                # listener gets progress and new events after every batch:
+                if listener:
+                    listener(indices[-1] + 1, np.concatenate(found_events) if found_events
+                             else np.empty(0, dtype=EVENTS_DTYPE))
+
+                if self.checkpointer and indices[-1] + 1 - checkpoint_index >= self.checkpointer.interval:
+                    checkpoint_index = indices[-1] + 1
+
+                    with self.metrics.time('checkpoint'):
+                        await self._save_checkpoint(file_name, checkpoint_key, checkpoint_index, total_events)
+        finally:
+            # events found before cancellation or error are still saved and extracted:
+            try:
+                track_store = self.processor.track_store
+
+                with self.metrics.time('tracks_dump'):
+                    track_store.flush()
+
+                if track_store.dump_path and exists(track_store.dump_path):
+                    self.metrics.count('bytes_written', getsize(track_store.dump_path))
+
+                motion_gate = self.processor.motion_gate
+
+                if motion_gate and motion_gate.checked_frames:
+                    self.logger.newline()
+                    self.logger.info("Motion gate skipped detection on {} of {} frames ({:.1%})."
+                                     .format(motion_gate.skipped_frames, motion_gate.checked_frames,
+                                             motion_gate.skip_rate))
+
+                # wait for background writer without blocking event loop:
+                await asyncio.get_running_loop().run_in_executor(None, self.saver.close)
+            finally:
+                try:
+                    # clip encoders and video writer are released even when saving failed:
+                    self.extractor.extract_events(file_name, final=True)
+                    self.extractor.extract_video(file_name)
+                finally:
+                    # queued clips are cut even when job is cancelled meanwhile:
+                    await asyncio.shield(self.extractor.cut_clips(input_path))
+
+        if cache_keys:
+            await asyncio.get_running_loop().run_in_executor(None, self._save_cache, *cache_keys)
+
+        # cancelled or failed job keeps its checkpoint:
+        if self.checkpointer:
+            self.checkpointer.remove(file_name)
+
+        return np.concatenate(total_events) if total_events else np.empty(0, dtype=EVENTS_DTYPE)
+
+    def _checkpoint_key(self, input_path):
+        return self.checkpointer.get_key(input_path, processor=OmegaConf.to_container(self.processor.config),
+                                         target_events=self.target_events.tolist(),
+                                         duplicate_frames=self.duplicate_frames, streaming=self.streaming,
+                                         detect_resolution=self.detect_resolution,
+                                         full_resolution=self.full_resolution, clip_mode=self.extractor.clip_mode,
+                                         frames_before=self.extractor.frames_before,
+                                         frames_after=self.extractor.frames_after)
+
+    async def _save_checkpoint(self, file_name, key, frame_index, total_events):
+        track_store = self.processor.track_store
 
-        async for index, frame in async_enumerate(self._get_frames(frames_dir)):
-            events = await self.processor.process_frame(file_name, index, frame)
-            filtered_events = self._filter_events(events)
+        # events and tracks up to checkpointed frame are written before state is saved:
+        track_store.flush()
+        await asyncio.get_running_loop().run_in_executor(None, self.saver.flush)
 
-            if filtered_events:
-                self.extractor.events_queue.append(filtered_events)
-                self.saver.save_events(filtered_events)
+        extractor_state = self.extractor.get_state()
+        open_events = extractor_state['events']
 
-                total_events.extend(filtered_events)
+        replay_index = max(int(open_events['frame_index'].min()) - self.extractor.frames_before, 1) \
+            if len(open_events) else frame_index + 1
+
+        await self.checkpointer.save(file_name, key, {'frame_index': frame_index,
+                                                      'replay_index': replay_index,
+                                                      'run_id': self.saver.run_id,
+                                                      'processor': self.processor.get_state(),
+                                                      'deduplicator': self.deduplicator,
+                                                      'extractor': extractor_state,
+                                                      'tracks': track_store.frames(replay_index, frame_index + 1),
+                                                      'dump_size': track_store.dump_size,
+                                                      'events': total_events})
+
+    async def _resume(self, file_name, checkpoint, frames):
+        frame_index, replay_index = checkpoint['frame_index'], checkpoint['replay_index']
+
+        # events saved by interrupted run after checkpoint are found again, so database gets no duplicates:
+        self.saver.run_id = checkpoint['run_id']
+        await asyncio.get_running_loop().run_in_executor(None, self.saver.delete_events, frame_index)
+
+        self.processor.set_state(checkpoint['processor'])
+        self.processor.track_store.restore(checkpoint['tracks'], replay_index, frame_index + 1,
+                                           checkpoint['dump_size'])
+
+        self.deduplicator = checkpoint['deduplicator']
+        self.extractor.set_state(checkpoint['extractor'], frame_index + 1)
+
+        open_events = checkpoint['extractor']['events']
+
+        # unfinished clips are written again to same files, frames before checkpoint are not processed:
+        for index in range(replay_index, frame_index + 1):
+            frame, _ = await frames.__anext__()
+            self.extractor.frame_buffer.append(index, frame)
+
+            frame_events = open_events[open_events['frame_index'] == index]
+
+            if len(frame_events):
+                self.extractor.events_queue.append(frame_events)
 
             self.extractor.extract_events(file_name)
 
-        self.extractor.extract_video(file_name)
+        return checkpoint['events']
 
-        return total_events
+    def _decode_scaled(self, input_path, start_index=0):
+        frame_size = self.decoder.probe_size(input_path)
+        detect_size = self.decoder.detect_size(frame_size, self.processor.input_size)
 
-    def _filter_events(self, events):
-        # filter target events:
-        res_events = list(filter(lambda ev: ev['event_name'] in self.target_events, events))
+        scale = np.array(frame_size * 2) / np.array(detect_size * 2)
+
+        # boxes found on small frames are stored in source coordinates:
+        self.processor.box_scale = scale
+
+        if not self.full_resolution:
+            self.extractor.visualizer.frame_scale = 1 / scale
+
+        return self.decoder.decode_frames(input_path, detect_size, self.full_resolution, start_index)
+
+    async def _load_cache(self, input_path):
+        loop = asyncio.get_running_loop()
+
+        # content hash keeps cache valid for renamed or copied videos:
+        file_hash = await loop.run_in_executor(None, self.cache.file_hash, input_path)
+
+        config = OmegaConf.to_container(self.processor.config)
+
+        detections_params = {name: config[name] for name in DETECTIONS_PARAMS}
+        detections_params['detect_resolution'] = self.detect_resolution
+
+        if config['roi_zones']:
+            detections_params.update((name, config[name]) for name in ZONES_PARAMS)
+
+        tracks_params = dict(detections_params, **{name: config[name] for name in TRACKS_PARAMS})
+        tracks_params['segments'] = (self.segment_tracker.workers, self.segment_tracker.overlap,
+                                     self.segment_tracker.iou_thresh) if self.segment_tracker else None
+
+        if config['adaptive_skip']:
+            tracks_params.update((name, config[name]) for name in ZONES_PARAMS)
+
+        detections_key = self.cache.get_key(file_hash, **detections_params)
+        tracks_key = self.cache.get_key(file_hash, **tracks_params)
+
+        if self.cache_tracks:
+            cached = await loop.run_in_executor(None, self.cache.load, tracks_key)
+
+            if cached is not None:
+                self._cached_tracks = cached['tracks']
 
-        # remove duplicate events:
-        res_events = list(filter(lambda ev: (ev['track_id'], ev['event_name']) not in self.unique_events, res_events))
+                self.logger.info("Replay {} cached track row(s) of '{}' video.".format(len(self._cached_tracks),
+                                                                                       input_path))
+                return detections_key, tracks_key
 
-        for event in res_events:
-            frame_index = event['frame_index']
-            track_id = event['track_id']
-            event_name = event['event_name']
+        # detection in segments runs in worker processes, so only tracks are cached there:
+        if self.segment_tracker is None:
+            cached = await loop.run_in_executor(None, self.cache.load, detections_key)
 
-            event_key = (track_id, event_name)
+            if cached is not None:
+                self.processor.cached_detections = dict(zip(cached['frame_indices'].tolist(),
+                                                            np.split(cached['detections'], cached['offsets'][1:-1])))
 
-            if event_key not in self.unique_events or \
-                    self.unique_events[event_key] - frame_index > self.duplicate_frames:
-                self.unique_events[event_key] = frame_index
+            self.processor.detections_spill = DetectionSpill(self.cache.cache_root)
+
+        return detections_key, tracks_key
+
+    def _save_cache(self, detections_key, tracks_key):
+        cached_detections = self.processor.cached_detections
+
+        spill = self.processor.detections_spill
+        detected_frames = len(spill) if spill is not None else 0
+
+        if self._cached_tracks is None:
+            track_store = self.processor.track_store
+
+            # tracks of early frames are left only in dump file when memory window is over:
+            if self.cache_tracks and track_store.first_frame == 1:
+                self.cache.save(tracks_key, tracks=track_store.frames(1, track_store.last_frame + 1))
+            elif self.cache_tracks and track_store.dump_path:
+                self.cache.save(tracks_key, tracks=track_store.load(track_store.dump_path))
+            elif self.cache_tracks:
+                self.logger.warning("Tracks of frames before {} are dropped by memory window and no dump file is set, "
+                                    "only detections are cached.".format(track_store.first_frame))
+
+            if detected_frames:
+                # replayed detections are stored with new ones, frames may go in any order:
+                for frame_index, detections in cached_detections.items():
+                    spill.append(frame_index, detections)
+
+                frame_indices, offsets, detections = spill.arrays()
+                self.cache.save(detections_key, frame_indices=frame_indices, offsets=offsets, detections=detections)
+
+        if spill is not None:
+            spill.close()
+
+        self.logger.newline()
+        self.logger.info("Detection cache: {} hit(s), {} miss(es), {} frame(s) replayed, {} frame(s) detected."
+                         .format(self.cache.hits, self.cache.misses, len(cached_detections), detected_frames))
+
+    async def _process_frames(self, input_path, frames, start_index=0):
+        if self._cached_tracks is not None:
+            # frames are still decoded here for clips and output video, tracks come from cache:
+            frame_indices = self._cached_tracks[:, 0]
+
+            async for batch in async_batched(async_enumerate(frames, start_index), self.processor.batch_size):
+                indices, batch_frames = zip(*batch)
+                output_frames, _ = zip(*batch_frames)
+
+                bounds = np.searchsorted(frame_indices, [indices[0] + 1] + [index + 2 for index in indices])
+
+                yield indices, output_frames, [self.processor.process_tracks(index, self._cached_tracks[start:end])
+                                               for index, start, end in zip(indices, bounds[:-1], bounds[1:])]
+
+            return
+
+        if self.segment_tracker is None:
+            async for batch in async_batched(async_enumerate(frames, start_index), self.processor.batch_size):
+                indices, batch_frames = zip(*batch)
+                output_frames, detect_frames = zip(*batch_frames)
+
+                yield indices, output_frames, await self.processor.process_frames(indices, detect_frames)
+
+            return
+
+        # frames are still decoded here for clips and output video, tracks come from segments:
+        segment_tracks = self.segment_tracker.track_frames(input_path, self.processor.config)
+
+        try:
+            async for index, (frame, _) in async_enumerate(frames):
+                try:
+                    tracks = await segment_tracks.__anext__()
+                except StopAsyncIteration:
+                    tracks = np.empty((0, 6), dtype=int)
+
+                yield [index], [frame], [self.processor.process_tracks(index, tracks)]
+        finally:
+            await segment_tracks.aclose()
+
+    def _filter_events(self, frame_index, events):
+        # filter target events:
+        res_events = events[np.isin(events['event_id'], self.target_events)]
 
-        return res_events
+        # remove events fired by same track in same zone less than duplicate interval ago:
+        return res_events[self.deduplicator.admit(frame_index, res_events)]
 
     async def _split_frames(self, input_path, frames_dir):
         ffmpeg = FFmpeg().option('y').input(input_path).output(join(frames_dir, '%d.png'))
@@ -82,6 +421,7 @@ class EventWatcher:
         self.logger.info("Split '{}' video into frames to '{}' dir.".format(input_path, frames_dir))
 
     @staticmethod
-    async def _get_frames(frames_dir):
-        for frame_name in sorted_listdir(frames_dir):
-            yield cv2.imread(str(join(frames_dir, frame_name)))
+    async def _get_frames(frames_dir, start_index=0):
+        for frame_name in islice(sorted_listdir(frames_dir), start_index, None):
+            frame = cv2.imread(str(join(frames_dir, frame_name)))
+            yield frame, frame
@@ -0,0 +1,172 @@
+import numpy as np
+
+from math import cos, sin, radians
+
+from constants import LINE_ZONE, POLYGON_ZONE, MAX_FRAME_SIZE
+
+
+def _cross(vectors1, vectors2):
+    return vectors1[:, 0] * vectors2[:, 1] - vectors1[:, 1] * vectors2[:, 0]
+
+
+def _expand_ranges(starts, counts):
+    # position of each item inside its own [start, start + count) range:
+    total = counts.sum()
+    owners = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    return owners, np.repeat(starts, counts) + offsets
+
+
+class GridIndex:
+    def __init__(self, bboxes, cell_size):
+        self.cell_size = cell_size
+
+        # zones outside of max frame area never contain any track:
+        bboxes = np.clip(bboxes.reshape(-1, 4), 0, MAX_FRAME_SIZE)
+
+        self.zones_count = len(bboxes)
+        self.origin = bboxes[:, :2].min(axis=0) if len(bboxes) else np.zeros(2)
+
+        cells_min, cells_max = self._cells(bboxes[:, :2], clip=False), self._cells(bboxes[:, 2:], clip=False)
+        self.shape = cells_max.max(axis=0) + 1 if len(bboxes) else np.zeros(2, dtype=int)
+
+        zone_ids, cell_ids = self._box_cells(cells_min, cells_max)
+
+        # cell -> zones mapping in compressed sparse row form:
+        order = np.argsort(cell_ids, kind='stable')
+        self.cell_zones = zone_ids[order]
+        self.cell_offsets = np.zeros(self.shape.prod() + 1, dtype=int)
+        self.cell_offsets[1:] = np.cumsum(np.bincount(cell_ids, minlength=self.shape.prod()))
+
+    def query_points(self, points):
+        return self.query_boxes(points, points)
+
+    def query_boxes(self, boxes_min, boxes_max):
+        if not self.shape.prod() or not len(boxes_min):
+            return np.empty(0, dtype=int), np.empty(0, dtype=int)
+
+        box_ids, cell_ids = self._box_cells(self._cells(boxes_min), self._cells(boxes_max))
+
+        starts = self.cell_offsets[cell_ids]
+        counts = self.cell_offsets[cell_ids + 1] - starts
+        owners, positions = _expand_ranges(starts, counts)
+
+        box_ids, zone_ids = box_ids[owners], self.cell_zones[positions]
+
+        # boxes covering several cells may meet same zone more than once:
+        pairs = np.unique(box_ids * self.zones_count + zone_ids)
+
+        return pairs // self.zones_count, pairs % self.zones_count
+
+    def _cells(self, points, clip=True):
+        cells = np.floor((points - self.origin) / self.cell_size).astype(int)
+        return np.clip(cells, 0, np.maximum(self.shape - 1, 0)) if clip else cells
+
+    def _box_cells(self, cells_min, cells_max):
+        widths, heights = (cells_max - cells_min + 1).T
+        owners, offsets = _expand_ranges(np.zeros(len(widths), dtype=int), widths * heights)
+
+        cells_x = cells_min[owners, 0] + offsets % widths[owners]
+        cells_y = cells_min[owners, 1] + offsets // widths[owners]
+
+        return owners, cells_y * self.shape[0] + cells_x
+
+
+class Zones:
+    def __init__(self, zones, cell_size):
+        self.names = [name for name, _, _ in zones]
+        self.kinds = [kind for _, kind, _ in zones]
+
+        self.line_ids = np.array([zone_id for zone_id, kind in enumerate(self.kinds) if kind == LINE_ZONE], dtype=int)
+        self.polygon_ids = np.array([zone_id for zone_id, kind in enumerate(self.kinds) if kind == POLYGON_ZONE],
+                                    dtype=int)
+
+        self.points = [np.array(zone_points, dtype=float).reshape(-1, 2) for _, _, zone_points in zones]
+        bboxes = np.array([np.concatenate([zone_points.min(axis=0), zone_points.max(axis=0)])
+                           for zone_points in self.points]).reshape(-1, 4)
+
+        self.lines = np.array([self.points[zone_id][:2] for zone_id in self.line_ids]).reshape(-1, 2, 2)
+
+        # polygon edges are stored flat, grouped by polygon:
+        polygons = [self.points[zone_id] for zone_id in self.polygon_ids]
+        self.edge_counts = np.array([len(polygon) for polygon in polygons], dtype=int)
+        self.edge_offsets = np.cumsum(self.edge_counts) - self.edge_counts
+        self.edge_starts = np.concatenate(polygons) if polygons else np.empty((0, 2))
+        self.edge_ends = np.concatenate([np.roll(polygon, -1, axis=0) for polygon in polygons]) \
+            if polygons else np.empty((0, 2))
+
+        self.line_index = GridIndex(bboxes[self.line_ids], cell_size)
+        self.polygon_index = GridIndex(bboxes[self.polygon_ids], cell_size)
+
+    @classmethod
+    def from_config(cls, config):
+        zones = [(zone.name, zone.kind, zone.points) for zone in config.zones]
+
+        # single line from angle and point is kept as long line zone:
+        if config.line_angle and config.line_point:
+            x_pos, y_pos = config.line_point
+            x_dir, y_dir = cos(radians(config.line_angle)), sin(radians(config.line_angle))
+
+            zones.append(('line', LINE_ZONE, [[x_pos - MAX_FRAME_SIZE * x_dir, y_pos - MAX_FRAME_SIZE * y_dir],
+                                              [x_pos + MAX_FRAME_SIZE * x_dir, y_pos + MAX_FRAME_SIZE * y_dir]]))
+
+        return cls(zones, config.zones_cell)
+
+    def find_crossings(self, prev_points, cur_points):
+        tracks, lines = self.line_index.query_boxes(np.minimum(prev_points, cur_points),
+                                                    np.maximum(prev_points, cur_points))
+
+        line_starts, line_ends = self.lines[lines, 0], self.lines[lines, 1]
+        prev_points, cur_points = prev_points[tracks], cur_points[tracks]
+
+        # points right on the line belong to its positive side, so every pass is counted once:
+        prev_sides = _cross(line_ends - line_starts, prev_points - line_starts) >= 0
+        cur_sides = _cross(line_ends - line_starts, cur_points - line_starts) >= 0
+
+        # line ends must lie on different sides of the movement:
+        start_sides = _cross(cur_points - prev_points, line_starts - prev_points)
+        end_sides = _cross(cur_points - prev_points, line_ends - prev_points)
+
+        crossed = (prev_sides != cur_sides) & (start_sides * end_sides <= 0)
+
+        return tracks[crossed], self.line_ids[lines[crossed]]
+
+    def find_near_lines(self, points, margin):
+        tracks, lines = self.line_index.query_boxes(points - margin, points + margin)
+
+        line_starts, line_ends = self.lines[lines, 0], self.lines[lines, 1]
+        directions, offsets = line_ends - line_starts, points[tracks] - line_starts
+
+        # distance to closest point of line segment:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            positions = np.nan_to_num(np.clip((offsets * directions).sum(axis=1) / (directions ** 2).sum(axis=1), 0, 1))
+
+        distances = np.linalg.norm(offsets - positions[:, None] * directions, axis=1)
+
+        near = np.zeros(len(points), dtype=bool)
+        near[tracks[distances <= margin]] = True
+
+        return near
+
+    def find_inside(self, points):
+        inside = np.zeros((len(points), len(self.polygon_ids)), dtype=bool)
+        tracks, polygons = self.polygon_index.query_points(points)
+
+        # ray casting over edges of candidate polygons:
+        pairs, edges = _expand_ranges(self.edge_offsets[polygons], self.edge_counts[polygons])
+
+        x_pos, y_pos = points[tracks[pairs], 0], points[tracks[pairs], 1]
+        (x_starts, y_starts), (x_ends, y_ends) = self.edge_starts[edges].T, self.edge_ends[edges].T
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            hits = ((y_starts > y_pos) != (y_ends > y_pos)) & \
+                   (x_pos < (x_ends - x_starts) * (y_pos - y_starts) / (y_ends - y_starts) + x_starts)
+
+        odd = np.bincount(pairs, weights=hits, minlength=len(tracks)) % 2 == 1
+        inside[tracks[odd], polygons[odd]] = True
+
+        return inside
+
+    def __len__(self):
+        return len(self.names)